@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+"""Benchmark pybase16 against a synthetic corpus of schemes and templates.
+
+The corpus is generated in a temporary directory, so no network access is
+required. Results are written as JSON so they can be compared across
+versions, e.g.:
+
+    python benchmarks/bench.py --schemes 500 --groups 20 -o results.json
+"""
+import io
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import inspect
+import statistics
+import tempfile
+from contextlib import redirect_stdout
+
+import pystache
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pybase16_builder import shared, builder, injector  # noqa: E402
+
+# the benchmarks are meant to be run against older revisions as well, so
+# anything that hasn't always been part of pybase16_builder is looked up
+# with a fallback
+try:
+    from pybase16_builder import cache  # noqa: E402
+except ImportError:
+    cache = None
+
+BASES = ["base{:02X}".format(x) for x in range(0, 16)]
+SUFFIXES = [
+    "hex",
+    "hex-r",
+    "hex-g",
+    "hex-b",
+    "hex-bgr",
+    "rgb-r",
+    "rgb-g",
+    "rgb-b",
+    "dec-r",
+    "dec-g",
+    "dec-b",
+]
+
+
+def get_variables():
+    """Return a list of all variables a template can refer to."""
+    suffixes = getattr(builder, "DERIVED_VARIABLES", SUFFIXES)
+    return ["scheme-name", "scheme-author", "scheme-slug"] + [
+        "{}-{}".format(base, suffix) for base in BASES for suffix in suffixes
+    ]
+
+
+def generate_corpus(base_dir, args):
+    """Generate a working directory with $args.schemes schemes spread over
+    $args.scheme_groups scheme directories and $args.groups template groups
+    with $args.subs sub-templates each in $base_dir."""
+    rand = random.Random(args.seed)
+    variables = get_variables()
+
+    for num in range(args.schemes):
+        scheme_dir = os.path.join(
+            base_dir, "schemes", "group-{}".format(num % args.scheme_groups)
+        )
+        os.makedirs(scheme_dir, exist_ok=True)
+        lines = [
+            'scheme: "Scheme {}"'.format(num),
+            'author: "Author {}"'.format(num),
+        ]
+        lines.extend(
+            '{}: "{:06x}"'.format(base, rand.randrange(0x1000000)) for base in BASES
+        )
+        path = os.path.join(scheme_dir, "scheme-{:05d}.yaml".format(num))
+        with open(path, "w", encoding="utf-8") as file_:
+            file_.write("\n".join(lines) + "\n")
+
+    for num in range(args.groups):
+        temp_dir = os.path.join(
+            base_dir, "templates", "template-{:03d}".format(num), "templates"
+        )
+        os.makedirs(temp_dir, exist_ok=True)
+        config = []
+        for sub_num in range(args.subs):
+            sub = "default" if sub_num == 0 else "sub-{}".format(sub_num)
+            config.append(
+                "{}:\n  extension: .conf\n  output: {}\n".format(sub, sub)
+            )
+            with open(
+                os.path.join(temp_dir, "{}.mustache".format(sub)), "w", encoding="utf-8"
+            ) as file_:
+                file_.write(
+                    generate_template(rand, variables, args.lines, args.density)
+                )
+        with open(os.path.join(temp_dir, "config.yaml"), "w", encoding="utf-8") as file_:
+            file_.write("".join(config))
+
+
+def generate_template(rand, variables, lines, density):
+    """Return a template of $lines lines where each line contains one of
+    $variables with a probability of $density."""
+    content = []
+    for num in range(lines):
+        if rand.random() < density:
+            content.append(
+                "setting_{} = #{{{{{}}}}}\n".format(num, rand.choice(variables))
+            )
+        else:
+            content.append("# plain line {} without any variables\n".format(num))
+    return "".join(content)
+
+
+def generate_recipients(base_dir, args):
+    """Generate $args.inject_files files prepared for injection and return
+    their paths."""
+    recipient_dir = os.path.join(base_dir, "recipients")
+    os.makedirs(recipient_dir, exist_ok=True)
+    paths = []
+    for num in range(args.inject_files):
+        group = "template-{:03d}".format(num % args.groups)
+        path = os.path.join(recipient_dir, "config-{}".format(num))
+        with open(path, "w", encoding="utf-8") as file_:
+            file_.write(
+                "before\n# %%base16_template: {}##default %%\n"
+                "# %%base16_template_end%%\nafter\n".format(group)
+            )
+        paths.append(path)
+    return paths
+
+
+def measure(func, repeat):
+    """Call $func $repeat times and return a dictionary of timings in
+    seconds."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return {
+        "min": min(timings),
+        "median": statistics.median(timings),
+        "max": max(timings),
+        "runs": timings,
+    }
+
+
+def get_formatted_scheme(scheme, slug):
+    """Return a copy of $scheme formatted with format_scheme."""
+    scheme = dict(scheme)
+    builder.format_scheme(scheme, slug)
+    return scheme
+
+
+def render_sub(sub, context):
+    """Render the sub-template $sub of a TemplateGroup with $context."""
+    if "compiled" in sub:
+        return sub["compiled"].render(context)
+    return pystache.render(sub["parsed"], context)
+
+
+def run_benchmarks(base_dir, args):
+    """Run all benchmarks in the corpus at $base_dir and return a dictionary
+    mapping benchmark names to timings. Benchmarks of features the tested
+    revision lacks are left out."""
+    results = {}
+    quiet = io.StringIO()
+    output_dir = os.path.join(base_dir, "output")
+
+    if hasattr(builder, "ResourceIndex"):
+        results["discovery"] = measure(builder.ResourceIndex, args.repeat)
+        index = builder.ResourceIndex()
+        scheme_files = index.get_scheme_files()
+        template_dirs = index.template_dirs
+    else:
+        results["discovery"] = measure(
+            lambda: (builder.get_template_dirs(), builder.get_scheme_files()),
+            args.repeat,
+        )
+        scheme_files = builder.get_scheme_files()
+        template_dirs = builder.get_template_dirs()
+    templates = [builder.TemplateGroup(path) for path in template_dirs]
+    for temp_group in templates:
+        if hasattr(temp_group, "load"):
+            temp_group.load()
+    load_scheme = getattr(builder, "load_scheme", shared.get_yaml_dict)
+    schemes = [load_scheme(path) for path in scheme_files]
+
+    results["yaml_loading"] = measure(
+        lambda: [load_scheme(path) for path in scheme_files], args.repeat
+    )
+    results["format_scheme"] = measure(
+        lambda: [get_formatted_scheme(scheme, "slug") for scheme in schemes],
+        args.repeat,
+    )
+    get_context = getattr(builder, "SchemeContext", get_formatted_scheme)
+    if hasattr(builder, "SchemeContext"):
+        results["scheme_context"] = measure(
+            lambda: [builder.SchemeContext(scheme, "slug") for scheme in schemes],
+            args.repeat,
+        )
+
+    def render():
+        for scheme in schemes:
+            context = get_context(scheme, "slug")
+            for temp_group in templates:
+                for sub in temp_group.templates.values():
+                    render_sub(sub, context)
+
+    results["rendering"] = measure(render, args.repeat)
+
+    build_options = {}
+    if "jobs" in inspect.signature(builder.build).parameters:
+        build_options["jobs"] = args.jobs
+
+    def build(**kwargs):
+        with redirect_stdout(quiet):
+            builder.build(base_output_dir=output_dir, **build_options, **kwargs)
+
+    def cold_build():
+        shutil.rmtree(output_dir, ignore_errors=True)
+        if cache is not None:
+            shutil.rmtree(shared.rel_to_cwd(cache.CACHE_DIR), ignore_errors=True)
+        build()
+
+    results["build_cold"] = measure(cold_build, args.repeat)
+    if "force" in inspect.signature(builder.build).parameters:
+        results["build_force"] = measure(lambda: build(force=True), args.repeat)
+        results["build_incremental"] = measure(build, args.repeat)
+
+    if args.inject_files:
+        recipients = generate_recipients(base_dir, args)
+        scheme = [builder.slugify(scheme_files[0])]
+
+        def inject():
+            with redirect_stdout(quiet):
+                injector.inject_into_files(scheme, recipients)
+
+        results["inject"] = measure(inject, args.repeat)
+
+    return results
+
+
+def get_version():
+    """Return the installed version of pybase16-builder if available."""
+    try:
+        from importlib.metadata import version
+
+        return version("pybase16-builder")
+    except Exception:
+        return None
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    argparser.add_argument("--schemes", type=int, default=200)
+    argparser.add_argument("--scheme-groups", type=int, default=10)
+    argparser.add_argument("--groups", type=int, default=10)
+    argparser.add_argument("--subs", type=int, default=2)
+    argparser.add_argument(
+        "--lines", type=int, default=40, help="number of lines per template"
+    )
+    argparser.add_argument(
+        "--density",
+        type=float,
+        default=0.5,
+        help="share of template lines containing a variable",
+    )
+    argparser.add_argument("--inject-files", type=int, default=20)
+    argparser.add_argument("--jobs", type=int, default=1)
+    argparser.add_argument("--repeat", type=int, default=3)
+    argparser.add_argument("--seed", type=int, default=0)
+    argparser.add_argument("-o", "--output", help="write JSON results to a file")
+    argparser.add_argument(
+        "--compare", metavar="FILE", help="compare results with a previous run"
+    )
+    args = argparser.parse_args()
+
+    base_dir = tempfile.mkdtemp(prefix="pybase16-bench-")
+    shared.CWD = base_dir
+    try:
+        generate_corpus(base_dir, args)
+        results = run_benchmarks(base_dir, args)
+    finally:
+        shutil.rmtree(base_dir, ignore_errors=True)
+
+    report = {
+        "version": get_version(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": vars(args),
+        "results": results,
+    }
+    report_json = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file_:
+            file_.write(report_json)
+    else:
+        print(report_json)
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as file_:
+            baseline = json.load(file_)["results"]
+
+    for name, timing in results.items():
+        line = "{:<20} {:>10.4f}s (median)".format(name, timing["median"])
+        if name in baseline:
+            line += " {:>7.2f}x baseline".format(
+                timing["median"] / baseline[name]["median"]
+            )
+        print(line, file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+import io
+import os
+import sys
+import time
+import tarfile
+import zipfile
+
+# archive formats and the tarfile modes used to write them as a stream
+ARCHIVE_FORMATS = {
+    "tar": "w|",
+    "tar.gz": "w|gz",
+    "tgz": "w|gz",
+    "tar.bz2": "w|bz2",
+    "tar.xz": "w|xz",
+    "tar.zst": "w|",
+    "zip": None,
+}
+
+
+def get_archive_format(path):
+    """Return the archive format matching the extension of $path. Archives
+    written to stdout ($path is "-") default to plain tar. Raise a ValueError
+    if the extension doesn't correspond to a supported format."""
+    if path == "-":
+        return "tar"
+    for archive_format in sorted(ARCHIVE_FORMATS, key=len, reverse=True):
+        if path.endswith(".{}".format(archive_format)):
+            return archive_format
+    raise ValueError("Unknown archive format for {}.".format(path))
+
+
+def open_zstd_stream(fileobj):
+    """Return a writable file object that compresses everything written to
+    it with zstd into $fileobj. Raise a ValueError if no zstd implementation
+    is available."""
+    try:
+        from compression import zstd
+
+        return zstd.ZstdFile(fileobj, "w")
+    except ImportError:
+        pass
+
+    try:
+        import zstandard
+    except ImportError:
+        raise ValueError(
+            "zstd compression requires Python 3.14 or the zstandard package."
+        )
+    return zstandard.ZstdCompressor().stream_writer(fileobj, closefd=False)
+
+
+class ArchiveWriter(object):
+    """Writes rendered files straight into a tar or zip archive at $path (or
+    to stdout if $path is "-") without creating any intermediate files."""
+
+    def __init__(self, path, archive_format=None):
+        self.path = path
+        self.format = archive_format or get_archive_format(path)
+        if self.format not in ARCHIVE_FORMATS:
+            raise ValueError("Unknown archive format {}.".format(self.format))
+        self.mtime = time.time()
+        self.zstd_stream = None
+
+        if path == "-":
+            self.fileobj = sys.stdout.buffer
+        else:
+            self.fileobj = open(path, "wb")
+
+        try:
+            if self.format == "zip":
+                self.archive = zipfile.ZipFile(
+                    self.fileobj, "w", compression=zipfile.ZIP_DEFLATED
+                )
+            elif self.format == "tar.zst":
+                self.zstd_stream = open_zstd_stream(self.fileobj)
+                self.archive = tarfile.open(fileobj=self.zstd_stream, mode="w|")
+            else:
+                self.archive = tarfile.open(
+                    fileobj=self.fileobj, mode=ARCHIVE_FORMATS[self.format]
+                )
+        except Exception:
+            self._close_fileobj()
+            if path != "-":
+                os.remove(path)
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def add(self, name, content):
+        """Add a file named $name (a path relative to the archive root) with
+        the string $content to the archive."""
+        name = name.replace(os.sep, "/")
+        data = content.encode("utf-8")
+        if self.format == "zip":
+            info = zipfile.ZipInfo(name, time.localtime(self.mtime)[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.external_attr = 0o644 << 16
+            self.archive.writestr(info, data)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = self.mtime
+            info.mode = 0o644
+            self.archive.addfile(info, io.BytesIO(data))
+
+    def close(self):
+        """Finish the archive."""
+        self.archive.close()
+        if self.zstd_stream is not None:
+            self.zstd_stream.close()
+        self._close_fileobj()
+
+    def _close_fileobj(self):
+        if self.path == "-":
+            self.fileobj.flush()
+        else:
+            self.fileobj.close()
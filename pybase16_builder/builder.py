@@ -1,36 +1,202 @@
 import os
+import re
+import sys
+import json
+import shutil
+import time
 import asyncio
+import hashlib
+import tempfile
+import itertools
+import multiprocessing
 import aiofiles
 import pystache
-from glob import glob
-from .shared import get_yaml_dict, rel_to_cwd, JobOptions, verb_msg, compat_event_loop
+import glob
+import fnmatch
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from .archive import ArchiveWriter
+from . import profiling
+from .cache import FileCache
+from .renderer import CompiledTemplate, RENDERER_VERSION
+from .store import SchemeStore
+from .shared import (
+    get_yaml_dict,
+    get_file_hash,
+    rel_to_cwd,
+    JobOptions,
+    verb_msg,
+    compat_event_loop,
+)
+
+MANIFEST_NAME = ".pybase16-manifest.json"
+MANIFEST_VERSION = 1
+BASES = ["base{:02X}".format(x) for x in range(0, 16)]
+SCHEME_KEYS = ["scheme", "author"] + BASES
+HEX_COLOR = re.compile(r"^[0-9a-fA-F]{6}$")
+MAX_RENDERS = 32
+MAX_OPEN_FILES = 64
+# worker processes can only be initialized from Python 3.7 on
+POOL_INITIALIZER = sys.version_info >= (3, 7)
+# sub-templates that took at least this many seconds to render are rendered
+# on their own rather than along with the rest of a scheme
+SPLIT_TIME = 0.01
+
+# a single output to build: a scheme rendered with one sub-template, along
+# with where to write it, its digest for the manifest and its estimated cost
+BuildUnit = namedtuple(
+    "BuildUnit",
+    [
+        "scheme_file",
+        "scheme_slug",
+        "group",
+        "temp",
+        "output_dir",
+        "filename",
+        "output",
+        "exists",
+        "digest",
+        "cost",
+    ],
+)
+
+
+class SubTemplate(dict):
+    """Settings of a single sub-template as specified in a config.yaml,
+    along with the path of its mustache file. A CompiledTemplate based on the
+    mustache file ("compiled"), the pystache object it was parsed into
+    ("parsed") and the content hash of the file ("hash") are only added
+    when they're first accessed, so sub-templates that are never rendered
+    are never parsed. Compiled templates are looked up in the FileCache
+    $cache if it's provided."""
+
+    def __init__(self, settings, path, group_name, cache=None):
+        super().__init__(settings)
+        self["path"] = path
+        self.group_name = group_name
+        self.cache = cache
+
+    def __missing__(self, key):
+        if key == "hash":
+            self["hash"] = get_file_hash(self["path"])
+        elif key == "parsed":
+            self["parsed"] = self["compiled"].parsed
+        elif key == "compiled":
+            self.load()
+        else:
+            raise KeyError(key)
+        return self[key]
+
+    def __getstate__(self):
+        # FileCache instances stay in the process that saves them
+        state = self.__dict__.copy()
+        state["cache"] = None
+        return state
+
+    def load(self):
+        """Parse the mustache file (unless it's already been parsed)."""
+        if dict.__contains__(self, "compiled"):
+            return
+        with profiling.phase("load_templates", template_group=self.group_name):
+            compiled, hash_ = get_compiled_template(self["path"], self.cache)
+        self["compiled"] = compiled
+        self["hash"] = hash_
 
 
 class TemplateGroup(object):
     """Representation of a template group, i.e. a group of templates specified
-    in a config.yaml."""
+    in a config.yaml. If $subs is given, only the sub-templates it names are
+    part of the group. Raise a FileNotFoundError if the group has no
+    config.yaml."""
 
-    def __init__(self, base_path):
+    def __init__(self, base_path, cache=None, subs=None):
         self.base_path = base_path
         self.name = os.path.basename(base_path.rstrip("/"))
-        self.templates = self.get_templates()
+        self.config_path = rel_to_cwd(self.base_path, "templates", "config.yaml")
+        if not os.path.isfile(self.config_path):
+            raise FileNotFoundError(None, None, self.config_path)
+        self.templates = self.get_templates(cache, subs)
+        self.config_hash = get_file_hash(self.config_path)
 
-    def get_templates(self):
+    def get_templates(self, cache=None, subs=None):
         """
-        Return a list of template_dicts based on the config.yaml in
-        $self.base_path. Keys correspond to templates and values represent
-        further settings regarding each template. A pystache object containing
-        the parsed corresponding mustache file is added to the sub-dictionary.
+        Return a dictionary of SubTemplate instances based on the config.yaml
+        in $self.base_path. Keys correspond to templates and values represent
+        further settings regarding each template. Mustache files are parsed
+        on first use; parsed templates are looked up in the FileCache $cache
+        if it's provided. If $subs is given, only those templates are
+        included; raise a ValueError if one of them doesn't exist.
         """
-        config_path = rel_to_cwd(self.base_path, "templates", "config.yaml")
-        templates = get_yaml_dict(config_path)
-        for temp, sub in templates.items():
+        config = get_yaml_dict(self.config_path)
+        if subs is not None:
+            missing = [sub for sub in subs if sub not in config]
+            if missing:
+                raise ValueError(
+                    "Template {} has no sub-template {}.".format(
+                        self.name, ", ".join(missing)
+                    )
+                )
+            config = {temp: config[temp] for temp in config if temp in subs}
+
+        templates = {}
+        for temp, settings in config.items():
             mustache_path = os.path.join(
-                get_parent_dir(config_path), "{}.mustache".format(temp)
+                get_parent_dir(self.config_path), "{}.mustache".format(temp)
             )
-            sub["parsed"] = get_pystache_parsed(mustache_path)
+            templates[temp] = SubTemplate(settings, mustache_path, self.name, cache)
         return templates
 
+    def load(self):
+        """Parse all mustache files of the group that haven't been parsed
+        yet."""
+        for sub in self.templates.values():
+            sub.load()
+
+    def get_input_hashes(self):
+        """Return a dictionary mapping the paths of all files this template
+        group depends on to their content hashes."""
+        hashes = {self.config_path: self.config_hash}
+        for sub in self.templates.values():
+            hashes[sub["path"]] = sub["hash"]
+        return hashes
+
+
+def get_template_selection(templates):
+    """Return a dictionary mapping template group paths to the names of the
+    sub-templates selected from them, or None if the whole group is
+    selected. Each item of the list $templates is the path of a template
+    group, optionally followed by "##" and the name of a sub-template, as
+    with injection markers ("group##" selects the default
+    sub-template)."""
+    selection = {}
+    for temp in templates:
+        path, sep, sub = temp.partition("##")
+        if not sep:
+            selection[path] = None
+        elif path not in selection or selection[path] is not None:
+            selection.setdefault(path, []).append(sub or "default")
+    return selection
+
+
+def load_template_groups(selection, cache=None):
+    """Return a list of TemplateGroup instances for the template selection
+    $selection (see get_template_selection), looking up parsed templates in
+    the FileCache $cache. Groups without a config.yaml are skipped with a
+    warning. Raise a LookupError if no group is left."""
+    templates = []
+    for path, subs in selection.items():
+        try:
+            templates.append(TemplateGroup(path, cache, subs))
+        except FileNotFoundError as e:
+            verb_msg(
+                'Skipping template "{}", {} not found.'.format(
+                    os.path.basename(path.rstrip("/")), e.filename
+                )
+            )
+    if not templates:
+        raise LookupError
+    return templates
+
 
 def get_parent_dir(base_dir, level=1):
     "Get the directory $level levels above $base_dir."
@@ -48,34 +214,132 @@ def get_pystache_parsed(mustache_file):
     return parsed
 
 
-def get_template_dirs():
+def get_template_cache():
+    """Return the FileCache holding compiled templates. Its entries are tied
+    to the versions of pystache and the renderer that produced them."""
+    version = "{}/{}".format(getattr(pystache, "__version__", ""), RENDERER_VERSION)
+    return FileCache("templates", version)
+
+
+def get_compiled_template(mustache_file, cache=None):
+    """Return a tuple of a CompiledTemplate based on the contents of
+    $mustache_file and the content hash of that file. If a FileCache is
+    provided as $cache (see get_template_cache), the template is only parsed
+    if the cache doesn't hold an entry for the current content."""
+    with open(mustache_file, "rb") as file_:
+        content = file_.read()
+    hash_ = hashlib.sha256(content).hexdigest()
+    # normalize newlines the same way reading in text mode would
+    text = content.decode("utf-8").replace("\r\n", "\n").replace("\r", "\n")
+
+    cached = cache.get(mustache_file, hash_) if cache is not None else None
+    if isinstance(cached, dict) and "parts" in cached:
+        return CompiledTemplate.from_parts(text, cached["parts"]), hash_
+
+    compiled = CompiledTemplate(pystache.parse(text))
+    if cache is not None:
+        parts = None if compiled.parts is None else [list(p) for p in compiled.parts]
+        cache.set(mustache_file, hash_, {"parts": parts})
+    return compiled, hash_
+
+
+class ResourceIndex(object):
+    """In-memory index of all scheme files and template groups in the working
+    directory. Schemes are expected at schemes/*/*.yaml and template groups
+    at templates/*/templates/config.yaml. Both are found in a single
+    traversal, so any number of patterns can be matched against the index
+    without touching the file system again."""
+
+    def __init__(self):
+        self.scheme_files = []
+        self.scheme_names = {}
+        self.template_dirs = []
+        self.scan()
+
+    def scan(self):
+        """(Re)build the index."""
+        with profiling.phase("discovery"):
+            self._scan()
+
+    def _scan(self):
+        self.scheme_files = []
+        self.scheme_names = {}
+        for group in scan_dirs(rel_to_cwd("schemes")):
+            try:
+                entries = sorted(os.scandir(group.path), key=lambda e: e.name)
+            except OSError:
+                continue
+            for entry in entries:
+                if entry.name.startswith(".") or not entry.name.endswith(".yaml"):
+                    continue
+                if entry.is_dir():
+                    continue
+                self.scheme_files.append(entry.path)
+                self.scheme_names.setdefault(entry.name, []).append(entry.path)
+
+        self.template_dirs = [
+            group.path
+            for group in scan_dirs(rel_to_cwd("templates"))
+            if os.path.isfile(os.path.join(group.path, "templates", "config.yaml"))
+        ]
+
+    def get_scheme_dirs(self):
+        """Return a set of all scheme directories."""
+        return set(get_parent_dir(path) for path in self.scheme_files)
+
+    def get_scheme_files(self, patterns=None):
+        """Return a list of all (or those matching any of $patterns) yaml
+        (scheme) files."""
+        if not patterns:
+            return list(self.scheme_files)
+
+        names = list(self.scheme_names)
+        scheme_files = []
+        seen = set()
+        for pattern in patterns:
+            pattern = "{}.yaml".format(pattern)
+            if glob.has_magic(pattern):
+                matches = fnmatch.filter(names, pattern)
+            else:
+                matches = [pattern] if pattern in self.scheme_names else []
+            for name in matches:
+                for path in self.scheme_names[name]:
+                    if path not in seen:
+                        seen.add(path)
+                        scheme_files.append(path)
+        return scheme_files
+
+
+def scan_dirs(base_dir):
+    """Return a sorted list of DirEntry objects for all non-hidden
+    directories in $base_dir."""
+    try:
+        entries = os.scandir(base_dir)
+    except OSError:
+        return []
+    return sorted(
+        (e for e in entries if not e.name.startswith(".") and e.is_dir()),
+        key=lambda e: e.name,
+    )
+
+
+def get_template_dirs(index=None):
     """Return a set of all template directories."""
-    temp_glob = rel_to_cwd("templates", "**", "templates", "config.yaml")
-    temp_groups = glob(temp_glob)
-    temp_groups = [get_parent_dir(path, 2) for path in temp_groups]
-    return set(temp_groups)
+    index = index or ResourceIndex()
+    return set(index.template_dirs)
 
 
-def get_scheme_dirs():
+def get_scheme_dirs(index=None):
     """Return a set of all scheme directories."""
-    scheme_glob = rel_to_cwd("schemes", "**", "*.yaml")
-    scheme_groups = glob(scheme_glob)
-    scheme_groups = [get_parent_dir(path) for path in scheme_groups]
-    return set(scheme_groups)
+    index = index or ResourceIndex()
+    return index.get_scheme_dirs()
 
 
-def get_scheme_files(patterns=None):
+def get_scheme_files(patterns=None, index=None):
     """Return a list of all (or those matching $pattern) yaml (scheme)
     files."""
-    patterns = patterns or ["*"]
-    pattern_list = ["{}.yaml".format(pattern) for pattern in patterns]
-    scheme_files = []
-    for scheme_path in get_scheme_dirs():
-        for pattern in pattern_list:
-            file_paths = glob(os.path.join(scheme_path, pattern))
-            scheme_files.extend(file_paths)
-
-    return scheme_files
+    index = index or ResourceIndex()
+    return index.get_scheme_files(patterns)
 
 
 def reverse_hex(hex_str):
@@ -84,32 +348,291 @@ def reverse_hex(hex_str):
     return hex_str
 
 
+# lookup tables for the conversion of color channel bytes
+RGB_TABLE = tuple(str(x) for x in range(0, 256))
+DEC_TABLE = tuple(str(x / 255) for x in range(0, 256))
+
+# derived variables by suffix; each function receives the hex string of a
+# color (as specified in the scheme, so its case is preserved) and its bytes
+DERIVED_VARIABLES = {
+    "hex": lambda hex_, rgb: hex_,
+    "hex-r": lambda hex_, rgb: hex_[0:2],
+    "hex-g": lambda hex_, rgb: hex_[2:4],
+    "hex-b": lambda hex_, rgb: hex_[4:6],
+    "hex-bgr": lambda hex_, rgb: hex_[4:6] + hex_[2:4] + hex_[0:2],
+    "rgb-r": lambda hex_, rgb: RGB_TABLE[rgb[0]],
+    "rgb-g": lambda hex_, rgb: RGB_TABLE[rgb[1]],
+    "rgb-b": lambda hex_, rgb: RGB_TABLE[rgb[2]],
+    "dec-r": lambda hex_, rgb: DEC_TABLE[rgb[0]],
+    "dec-g": lambda hex_, rgb: DEC_TABLE[rgb[1]],
+    "dec-b": lambda hex_, rgb: DEC_TABLE[rgb[2]],
+}
+DERIVED_KEYS = {
+    "{}-{}".format(base, suffix): (index, func)
+    for index, base in enumerate(BASES)
+    for suffix, func in DERIVED_VARIABLES.items()
+}
+
+
+class SchemeContext(dict):
+    """Render context for a scheme. Only the scheme name, author and slug as
+    well as any additional keys of the scheme are stored directly. The 16
+    colors are kept as bytes and the variables derived from them (e.g.
+    base00-hex-r or base00-dec-r) are computed when they are first looked
+    up."""
+
+    def __init__(self, scheme, slug):
+        super().__init__(
+            (key, value)
+            for key, value in scheme.items()
+            if key not in SCHEME_KEYS and key not in DERIVED_KEYS
+        )
+        self["scheme-name"] = scheme["scheme"]
+        self["scheme-author"] = scheme["author"]
+        self["scheme-slug"] = slug
+        self.hex_colors = tuple(scheme[base] for base in BASES)
+        self.colors = tuple(bytes.fromhex(hex_) for hex_ in self.hex_colors)
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in DERIVED_KEYS
+
+    def __missing__(self, key):
+        index, func = DERIVED_KEYS[key]
+        value = func(self.hex_colors[index], self.colors[index])
+        self[key] = value
+        return value
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def to_dict(self):
+        """Return a plain dictionary containing all variables."""
+        for key in DERIVED_KEYS:
+            self[key]
+        return dict(self)
+
+
 def format_scheme(scheme, slug):
-    """Change $scheme so it can be applied to a template."""
-    scheme["scheme-name"] = scheme.pop("scheme")
-    scheme["scheme-author"] = scheme.pop("author")
-    scheme["scheme-slug"] = slug
-    bases = ["base{:02X}".format(x) for x in range(0, 16)]
-    for base in bases:
-        scheme["{}-hex".format(base)] = scheme.pop(base)
-        scheme["{}-hex-r".format(base)] = scheme["{}-hex".format(base)][0:2]
-        scheme["{}-hex-g".format(base)] = scheme["{}-hex".format(base)][2:4]
-        scheme["{}-hex-b".format(base)] = scheme["{}-hex".format(base)][4:6]
-        scheme["{}-hex-bgr".format(base)] = reverse_hex(scheme["{}-hex".format(base)])
-
-        scheme["{}-rgb-r".format(base)] = str(int(scheme["{}-hex-r".format(base)], 16))
-        scheme["{}-rgb-g".format(base)] = str(int(scheme["{}-hex-g".format(base)], 16))
-        scheme["{}-rgb-b".format(base)] = str(int(scheme["{}-hex-b".format(base)], 16))
-
-        scheme["{}-dec-r".format(base)] = str(
-            int(scheme["{}-rgb-r".format(base)]) / 255
+    """Change $scheme so it can be applied to a template. This computes all
+    variables upfront; use SchemeContext to compute them on demand
+    instead."""
+    context = SchemeContext(scheme, slug).to_dict()
+    scheme.clear()
+    scheme.update(context)
+
+
+def load_scheme(scheme_file):
+    """Return the scheme dictionary from $scheme_file. Raise a ValueError if
+    it lacks any of the required keys or contains invalid colors."""
+    scheme = get_yaml_dict(scheme_file)
+    missing = [key for key in SCHEME_KEYS if key not in scheme]
+    if missing:
+        raise ValueError("Missing keys: {}".format(", ".join(missing)))
+
+    for base in BASES:
+        if not isinstance(scheme[base], str) or not HEX_COLOR.match(scheme[base]):
+            raise ValueError("Invalid color for {}: {!r}".format(base, scheme[base]))
+    return scheme
+
+
+def get_scheme_context(scheme_file, store=None):
+    """Return the formatted render context of $scheme_file as a plain
+    dictionary. If a SchemeStore is provided as $store, the file is only
+    parsed if its current content isn't in the store yet."""
+    if store is None:
+        return SchemeContext(load_scheme(scheme_file), slugify(scheme_file)).to_dict()
+
+    hash_ = get_file_hash(scheme_file)
+    context = store.get(scheme_file, hash_)
+    if context is None:
+        context = SchemeContext(load_scheme(scheme_file), slugify(scheme_file))
+        context = context.to_dict()
+        store.set(scheme_file, hash_, context)
+    return context
+
+
+def index_schemes(store, scheme_files=None):
+    """Add the contexts of all $scheme_files (by default all schemes in the
+    working directory) that aren't up to date yet to SchemeStore $store.
+    Return True if all of them could be loaded."""
+    if scheme_files is None:
+        scheme_files = ResourceIndex().get_scheme_files()
+    result = True
+    for scheme_file in scheme_files:
+        try:
+            get_scheme_context(scheme_file, store)
+        except Exception as e:
+            verb_msg("{}: {!s}".format(scheme_file, e), lvl=2)
+            result = False
+    store.save()
+    return result
+
+
+def load_manifest(base_output_dir):
+    """Return the build manifest stored in $base_output_dir. If there is none
+    or it can't be used, return an empty manifest instead."""
+    manifest_path = os.path.join(base_output_dir, MANIFEST_NAME)
+    try:
+        with open(manifest_path, "r", encoding="utf-8") as file_:
+            manifest = json.load(file_)
+    except (FileNotFoundError, ValueError):
+        manifest = {}
+
+    if manifest.get("version") != MANIFEST_VERSION:
+        manifest = {"version": MANIFEST_VERSION, "inputs": {}, "outputs": {}}
+    return manifest
+
+
+def write_manifest(base_output_dir, manifest, listings=None):
+    """Write $manifest to $base_output_dir, dropping entries for outputs that
+    no longer exist. $listings can map output directories to sets of the
+    files they contain, as returned by prepare_output_dirs, to avoid checking
+    each file individually."""
+    listings = listings or {}
+
+    def exists(output):
+        output_dir, filename = os.path.split(os.path.join(base_output_dir, output))
+        try:
+            return filename in listings[output_dir]
+        except KeyError:
+            return os.path.isfile(os.path.join(output_dir, filename))
+
+    manifest["outputs"] = {
+        out: digest for out, digest in manifest["outputs"].items() if exists(out)
+    }
+    manifest_path = os.path.join(base_output_dir, MANIFEST_NAME)
+    tmp_path = "{}.tmp".format(manifest_path)
+    with open(tmp_path, "w", encoding="utf-8") as file_:
+        json.dump(manifest, file_, indent=1, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def prepare_output_dirs(base_output_dir, templates):
+    """Create the output directories for all sub-templates of the
+    TemplateGroup instances in $templates below $base_output_dir. Return a
+    dictionary mapping each output directory to a set of the names of the
+    files it already contains."""
+    listings = {}
+    for temp_group in templates:
+        for sub in temp_group.templates.values():
+            output_dir = os.path.join(base_output_dir, temp_group.name, sub["output"])
+            if output_dir in listings:
+                continue
+            os.makedirs(output_dir, exist_ok=True)
+            listings[output_dir] = {
+                entry.name for entry in os.scandir(output_dir) if not entry.is_dir()
+            }
+    return listings
+
+
+def get_output_digest(*hashes):
+    """Combine the content $hashes of all inputs of an output file into a
+    single digest."""
+    return hashlib.sha256(":".join(hashes).encode("ascii")).hexdigest()
+
+
+def parse_shard(shard):
+    """Return a tuple of the shard index and shard count given as "K/N" in
+    $shard. Raise a ValueError if it isn't in that format or K isn't between
+    1 and N."""
+    try:
+        index, count = (int(num) for num in shard.split("/"))
+    except ValueError:
+        raise ValueError("Invalid shard {}, expected K/N.".format(shard))
+    if not 1 <= index <= count:
+        raise ValueError("Invalid shard {}, K must be between 1 and N.".format(shard))
+    return index, count
+
+
+def get_shard(output, count):
+    """Return the shard (between 1 and $count) that output file $output, a
+    path relative to the output directory, belongs to. The result only
+    depends on $output, so every output is assigned to exactly one shard on
+    any machine."""
+    digest = hashlib.sha256(output.replace(os.sep, "/").encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % count + 1
+
+
+def get_inputs_digest(templates, scheme_files):
+    """Return a digest of the names and contents of all inputs of a build of
+    $scheme_files with the TemplateGroup instances in $templates. Paths are
+    taken relative to the working directory, so builds of the same inputs in
+    different places have the same digest."""
+    inputs = {}
+    for temp_group in templates:
+        inputs.update(temp_group.get_input_hashes())
+    for scheme_file in scheme_files:
+        inputs[scheme_file] = get_file_hash(scheme_file)
+    hash_ = hashlib.sha256()
+    for path in sorted(inputs):
+        rel_path = os.path.relpath(path, rel_to_cwd()).replace(os.sep, "/")
+        hash_.update("{}\0{}\n".format(rel_path, inputs[path]).encode("utf-8"))
+    return hash_.hexdigest()
+
+
+def merge_shards(shard_dirs, base_output_dir):
+    """Merge the output directories $shard_dirs of a sharded build into
+    $base_output_dir, combining their manifests. Output files are hardlinked
+    if possible and copied otherwise. Raise a ValueError unless $shard_dirs
+    hold exactly one build of each shard of the same shard count, built
+    from the same inputs (see get_inputs_digest), so the merged directory is
+    known to contain every output. Return the number of
+    merged files."""
+    manifests = []
+    for shard_dir in shard_dirs:
+        manifest = load_manifest(shard_dir)
+        if "shard" not in manifest:
+            raise ValueError("{} doesn't contain a sharded build.".format(shard_dir))
+        manifests.append(manifest)
+
+    counts = {manifest["shard"]["count"] for manifest in manifests}
+    if len(counts) != 1:
+        raise ValueError("Shards were built with different shard counts.")
+    if len({manifest["shard"].get("inputs") for manifest in manifests}) != 1:
+        raise ValueError(
+            "Shards were built from different templates, schemes or inputs."
         )
-        scheme["{}-dec-g".format(base)] = str(
-            int(scheme["{}-rgb-g".format(base)]) / 255
+    indices = sorted(manifest["shard"]["index"] for manifest in manifests)
+    if indices != list(range(1, counts.pop() + 1)):
+        raise ValueError(
+            "Expected each shard exactly once, got shards {}.".format(
+                ", ".join(str(index) for index in indices)
+            )
         )
-        scheme["{}-dec-b".format(base)] = str(
-            int(scheme["{}-rgb-b".format(base)]) / 255
+
+    # check all manifests before touching $base_output_dir
+    merged = {"version": MANIFEST_VERSION, "inputs": {}, "outputs": {}}
+    sources = {}
+    for shard_dir, manifest in zip(shard_dirs, manifests):
+        for output, digest in manifest["outputs"].items():
+            if output in merged["outputs"]:
+                raise ValueError("{} is part of more than one shard.".format(output))
+            merged["outputs"][output] = digest
+            sources[output] = shard_dir
+        merged["inputs"].update(manifest["inputs"])
+        merged.setdefault("timings", {}).update(manifest.get("timings", {}))
+
+    # an interrupted merge must not leave a manifest describing the outputs
+    # that were there before, so it's only written once all files are in place
+    try:
+        os.remove(os.path.join(base_output_dir, MANIFEST_NAME))
+    except FileNotFoundError:
+        pass
+    for output, shard_dir in sources.items():
+        source = os.path.join(shard_dir, output)
+        target = os.path.join(base_output_dir, output)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        tmp_path = os.path.join(
+            os.path.dirname(target), ".{}.tmp".format(os.path.basename(target))
         )
+        try:
+            os.link(source, tmp_path)
+        except OSError:
+            shutil.copy2(source, tmp_path)
+        os.replace(tmp_path, target)
+
+    write_manifest(base_output_dir, merged)
+    return len(merged["outputs"])
 
 
 def slugify(scheme_file):
@@ -120,98 +643,667 @@ def slugify(scheme_file):
     return scheme_file_name.lower().replace(" ", "-")
 
 
-async def build_single(scheme_file, job_options):
-    """Build colorscheme from $scheme_file using $job_options. Return True if
-    completed without warnings. Otherwise false."""
-    scheme = get_yaml_dict(scheme_file)
-    scheme_slug = slugify(scheme_file)
-    format_scheme(scheme, scheme_slug)
-    scheme_name = scheme["scheme-name"]
-    warn = False  # set this for feedback to the caller
+_worker_templates = None
+
+
+def init_render_worker(templates):
+    """Initializer for render worker processes. Make $templates, a list of
+    TemplateGroup instances, available to render_units."""
+    global _worker_templates
+    _worker_templates = {temp_group.name: temp_group for temp_group in templates}
+
+
+def get_render_pool(jobs, templates):
+    """Return a ProcessPoolExecutor with $jobs worker processes that have
+    $templates, a list of TemplateGroup instances, available to render_units.
+    Where worker processes can't be initialized, they inherit the templates
+    by being forked from this process instead; if processes aren't forked
+    either, return None to render in this process."""
+    if POOL_INITIALIZER:
+        return ProcessPoolExecutor(
+            max_workers=jobs, initializer=init_render_worker, initargs=(templates,)
+        )
+    if multiprocessing.get_start_method() != "fork":
+        verb_msg("Rendering in several processes requires Python 3.7 or later.")
+        return None
+    # workers are only forked once the first job is submitted
+    init_render_worker(templates)
+    return ProcessPoolExecutor(max_workers=jobs)
+
+
+def load_scheme_context(scheme_file):
+    """Return a tuple of the formatted context of $scheme_file and the time
+    (in seconds) it took to load it."""
+    start = time.perf_counter()
+    context = SchemeContext(load_scheme(scheme_file), slugify(scheme_file))
+    return context.to_dict(), time.perf_counter() - start
+
+
+def render_units(selection, context, templates=None):
+    """Render each of the sub-templates in $selection, a list of (template
+    group name, sub-template name) tuples, with the formatted scheme
+    $context. $templates maps template group names to TemplateGroup
+    instances and defaults to the ones passed to init_render_worker. Return a
+    list of tuples of the rendered string and the time (in seconds)
+    rendering took, in the order of $selection."""
+    templates = templates or _worker_templates
+    rendered = []
+    for group, temp in selection:
+        start = time.perf_counter()
+        content = templates[group].templates[temp]["compiled"].render(context)
+        rendered.append((content, time.perf_counter() - start))
+    return rendered
+
+
+def get_batch_context(selection, context, templates):
+    """Return the part of the formatted scheme $context that the
+    sub-templates in $selection (see render_units) refer to, so only those
+    variables are sent to worker processes. $templates maps template group
+    names to TemplateGroup instances. If any of the sub-templates is rendered
+    by pystache, return all of $context."""
+    keys = set()
+    for group, temp in selection:
+        variables = templates[group].templates[temp]["compiled"].variables
+        if variables is None:
+            return context
+        keys |= variables
+    return {key: context[key] for key in keys if key in context}
 
-    if job_options.verbose:
-        print('Building colorschemes for scheme "{}"...'.format(scheme_name))
 
+def encode_output(content):
+    """Return string $content as it's supposed to be written to disk."""
+    if os.linesep != "\n":
+        content = content.replace("\n", os.linesep)
+    return content.encode("utf-8")
+
+
+async def has_content(path, data):
+    """Return True if the file at $path contains exactly the bytes $data."""
+    try:
+        if os.stat(path).st_size != len(data):
+            return False
+        async with aiofiles.open(path, "rb") as file_:
+            return await file_.read() == data
+    except FileNotFoundError:
+        return False
+
+
+def get_umask():
+    """Return the umask of this process."""
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+# read once, as the umask can only be read by changing it
+UMASK = get_umask()
+
+
+async def write_atomic(path, data):
+    """Write the bytes $data to $path by writing to a temporary file first
+    and renaming it, so $path never holds partially written content. An
+    existing file at $path keeps its permissions; new files get the default
+    permissions."""
+    fd, tmp_path = tempfile.mkstemp(
+        prefix=".{}.".format(os.path.basename(path)),
+        suffix=".tmp",
+        dir=os.path.dirname(path) or ".",
+    )
+    os.close(fd)
+    try:
+        async with aiofiles.open(tmp_path, "wb") as file_:
+            await file_.write(data)
+        try:
+            shutil.copymode(path, tmp_path)
+        except FileNotFoundError:
+            # mkstemp creates files only the owner can access
+            os.chmod(tmp_path, 0o666 & ~UMASK)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def get_unit_costs(templates, timings):
+    """Return a dictionary mapping (template group name, sub-template name)
+    tuples for the sub-templates of the TemplateGroup instances in
+    $templates to sort keys estimating how expensive rendering them is;
+    greater keys are more expensive. Render times measured by previous
+    builds, given in $timings as returned by get_render_timings, are used
+    where available. Sub-templates without one are estimated by the size of
+    their mustache file and sorted before all others, since their cost is
+    unknown."""
+    costs = {}
+    for temp_group in templates:
+        for temp, sub in temp_group.templates.items():
+            label = "{}##{}".format(temp_group.name, temp)
+            if label in timings:
+                costs[(temp_group.name, temp)] = (0, timings[label])
+                continue
+            try:
+                size = os.path.getsize(sub["path"])
+            except OSError:
+                size = 0
+            costs[(temp_group.name, temp)] = (1, size)
+    return costs
+
+
+def get_render_timings(manifest, render_times):
+    """Return the average render time of each sub-template recorded in
+    $manifest, updated with the times measured during a build, given in
+    $render_times as a dictionary mapping "group##sub" labels to a list of
+    the total time and the number of renders."""
+    timings = dict(manifest.get("timings", {}))
+    timings.update(
+        (label, total / count) for label, (total, count) in render_times.items()
+    )
+    return timings
+
+
+async def plan_scheme(scheme_file, job_options):
+    """Return a list of batches (see get_batches) of BuildUnit tuples for the
+    outputs of $scheme_file that need to be built using $job_options.
+    Outputs whose inputs haven't changed according to the build manifest are
+    skipped. The scheme is only loaded (in $job_options.pool if it's set) if
+    something needs to be built from it; its context is kept in
+    $job_options.contexts until all of its units are built."""
+    manifest = job_options.manifest
+    scheme_slug = slugify(scheme_file)
+
+    candidates = []
     for temp_group in job_options.templates:
 
-        for _, sub in temp_group.templates.items():
+        for temp, sub in temp_group.templates.items():
             output_dir = os.path.join(
                 job_options.base_output_dir, temp_group.name, sub["output"]
             )
-            try:
-                os.makedirs(output_dir)
-            except FileExistsError:
-                pass
-
             if sub["extension"] is not None:
                 filename = "base16-{}{}".format(scheme_slug, sub["extension"])
             else:
                 filename = "base16-{}".format(scheme_slug)
 
-            build_path = os.path.join(output_dir, filename)
+            output = os.path.join(temp_group.name, sub["output"], filename)
+            if job_options.shard is not None:
+                index, count = job_options.shard
+                if get_shard(output, count) != index:
+                    continue
+            candidates.append((temp_group, temp, sub, output_dir, filename, output))
 
-            # include a warning for files being overwritten to comply with
-            # base16 0.9.1
-            if os.path.isfile(build_path):
-                verb_msg("File {} exists and will be overwritten.".format(build_path))
-                warn = True
+    # schemes without outputs in this shard don't even need to be hashed
+    if not candidates:
+        return []
 
-            async with aiofiles.open(build_path, "w", encoding="utf-8") as file_:
-                file_content = pystache.render(sub["parsed"], scheme)
-                await file_.write(file_content)
+    with profiling.phase("hash_scheme"):
+        scheme_hash = get_file_hash(scheme_file)
+    manifest["inputs"][scheme_file] = scheme_hash
+
+    units = []
+    for temp_group, temp, sub, output_dir, filename, output in candidates:
+        digest = get_output_digest(scheme_hash, temp_group.config_hash, sub["hash"])
+        # archives are always built from scratch
+        exists = (
+            job_options.archive is None
+            and filename in job_options.listings[output_dir]
+        )
+        if (
+            not job_options.force
+            and exists
+            and manifest["outputs"].get(output) == digest
+        ):
+            job_options.stats["skipped"] += 1
+            continue
+
+        units.append(
+            BuildUnit(
+                scheme_file,
+                scheme_slug,
+                temp_group.name,
+                temp,
+                output_dir,
+                filename,
+                output,
+                exists,
+                digest,
+                job_options.costs[(temp_group.name, temp)],
+            )
+        )
+
+    # only load the scheme if something needs to be built from it
+    if not units:
+        return []
+
+    context = job_options.scheme_store.get(scheme_file, scheme_hash)
+    if context is None:
+        if job_options.pool is not None:
+            event_loop = asyncio.get_event_loop()
+            context, elapsed = await event_loop.run_in_executor(
+                job_options.pool, load_scheme_context, scheme_file
+            )
+        else:
+            context, elapsed = load_scheme_context(scheme_file)
+        profiling.record("load_scheme", elapsed, scheme=scheme_slug)
+        job_options.scheme_store.set(scheme_file, scheme_hash, context)
+
+    job_options.contexts[scheme_file] = context
+    job_options.remaining[scheme_file] = len(units)
+    if job_options.verbose:
+        print(
+            'Building colorschemes for scheme "{}"...'.format(
+                context["scheme-name"]
+            ),
+            file=job_options.msg_file,
+        )
+    return get_batches(units)
+
+
+def get_batches(units):
+    """Split the BuildUnit tuples $units of a single scheme into the batches
+    they are rendered in. Sending a unit to the process pool costs more than
+    rendering a typical sub-template, and so does scheduling it on its own
+    when rendering in this process, so all units of the scheme are rendered
+    in one batch, except for those that took at least SPLIT_TIME seconds in
+    previous builds."""
+    batches = []
+    rest = []
+    for unit in units:
+        if unit.cost[0] == 0 and unit.cost[1] >= SPLIT_TIME:
+            batches.append([unit])
+        else:
+            rest.append(unit)
+    if rest:
+        batches.append(rest)
+    return batches
+
+
+def get_batch_cost(batch):
+    """Return the estimated cost of rendering the BuildUnit tuples in
+    $batch, comparable like the costs returned by get_unit_costs."""
+    kind = max(unit.cost[0] for unit in batch)
+    return kind, sum(unit.cost[1] for unit in batch if unit.cost[0] == kind)
+
+
+async def build_batch(batch, job_options):
+    """Render the BuildUnit tuples in $batch, all of the same scheme, and
+    write their outputs using $job_options. Return True if completed without
+    warnings. Otherwise false. Rendering happens in $job_options.pool if
+    it's set."""
+    context = job_options.contexts[batch[0].scheme_file]
+    selection = [(unit.group, unit.temp) for unit in batch]
+    if job_options.pool is not None:
+        context = get_batch_context(selection, context, job_options.template_map)
+        event_loop = asyncio.get_event_loop()
+        rendered = await event_loop.run_in_executor(
+            job_options.pool, render_units, selection, context
+        )
+    else:
+        rendered = render_units(selection, context, job_options.template_map)
+
+    results = []
+    for unit, (file_content, elapsed) in zip(batch, rendered):
+        results.append(await write_unit(unit, file_content, elapsed, job_options))
+    return all(results)
 
-            if job_options.verbose:
-                print('Built colorschemes for scheme "{}".'.format(scheme_name))
 
+async def write_unit(unit, file_content, render_time, job_options):
+    """Write $file_content, the output of BuildUnit $unit that took
+    $render_time seconds to render, using $job_options. Return True if
+    completed without warnings. Otherwise false."""
+    start = time.perf_counter()
+    template = "{}##{}".format(unit.group, unit.temp)
+    labels = {"scheme": unit.scheme_slug, "template": template}
+    warn = False  # set this for feedback to the caller
+
+    # rendering may have happened in another process, so timings are recorded
+    # here rather than with profiling.phase
+    profiling.record("render", render_time, **labels)
+    render_times = job_options.render_times.setdefault(template, [0.0, 0])
+    render_times[0] += render_time
+    render_times[1] += 1
+
+    if job_options.archive is not None:
+        with profiling.phase("write", **labels):
+            job_options.archive.add(unit.output, file_content)
+    else:
+        build_path = os.path.join(unit.output_dir, unit.filename)
+        data = encode_output(file_content)
+        with profiling.phase("write", **labels):
+            async with job_options.file_semaphore:
+                if unit.exists and await has_content(build_path, data):
+                    job_options.stats["unchanged"] += 1
+                else:
+                    # include a warning for files being overwritten to comply
+                    # with base16 0.9.1
+                    if unit.exists:
+                        verb_msg(
+                            "File {} exists and will be overwritten.".format(
+                                build_path
+                            )
+                        )
+                        warn = True
+                    await write_atomic(build_path, data)
+                    job_options.stats["updated" if unit.exists else "new"] += 1
+
+        job_options.listings[unit.output_dir].add(unit.filename)
+        job_options.manifest["outputs"][unit.output] = unit.digest
+    job_options.stats["rebuilt"] += 1
+
+    profiling.record(
+        "build_unit",
+        render_time + time.perf_counter() - start,
+        unit="{}:{}".format(template, unit.scheme_slug),
+    )
     return not (warn)
 
 
-async def build_single_task(scheme_file, job_options):
-    """Worker thread for picking up scheme files from $queue and building b16
-    templates using $templates until it receives None."""
+async def plan_scheme_task(scheme_file, job_options):
+    """Run plan_scheme for $scheme_file, reporting errors instead of raising
+    them. Return a tuple of True if planning succeeded (otherwise False) and
+    the list of batches to build."""
     try:
-        return await build_single(scheme_file, job_options)
+        return True, await plan_scheme(scheme_file, job_options)
+    except Exception as e:
+        verb_msg("{}: {!s}".format(scheme_file, e), lvl=2)
+        return False, []
+
+
+async def build_batch_task(batch, job_options):
+    """Run build_batch for $batch, reporting errors instead of raising them.
+    Once all units of a scheme are done, its context is released and the
+    next scheme may be loaded."""
+    scheme_file = batch[0].scheme_file
+    try:
+        return await build_batch(batch, job_options)
     except Exception as e:
         verb_msg("{}: {!s}".format(scheme_file, e), lvl=2)
         return False
+    finally:
+        job_options.remaining[scheme_file] -= len(batch)
+        if not job_options.remaining[scheme_file]:
+            context = job_options.contexts.pop(scheme_file)
+            job_options.scheme_slots.release()
+            if job_options.verbose:
+                print(
+                    'Built colorschemes for scheme "{}".'.format(
+                        context["scheme-name"]
+                    ),
+                    file=job_options.msg_file,
+                )
 
 
 async def build_scheduler(scheme_files, job_options):
-    """Create a task list from scheme_files and run tasks asynchronously."""
-    task_list = [build_single_task(f, job_options) for f in scheme_files]
-    return await asyncio.gather(*task_list)
+    """Build $scheme_files asynchronously. Each scheme is checked against
+    the manifest and loaded if necessary, then the resulting batches of
+    units (see get_batches) are rendered and written, most expensive first
+    (see get_unit_costs), so a few large templates don't hold up the end of
+    the build. At most $job_options.max_renders schemes are loaded at once,
+    so expensive units are picked from those, and a new scheme is only
+    loaded once all units of a previous one are finished. At most
+    $job_options.max_renders batches are in flight and at most
+    $job_options.max_open_files files are open at any time. Return a list of
+    results, one for each scheme and batch."""
+    job_options.file_semaphore = asyncio.Semaphore(job_options.max_open_files)
+    job_options.scheme_slots = asyncio.Semaphore(job_options.max_renders)
+    queue = asyncio.PriorityQueue()
+    # keeps batches of equal cost in the order of schemes and prevents
+    # comparing batches
+    counter = itertools.count()
+    pending = iter(scheme_files)
+    results = []
+
+    async def planner():
+        for scheme_file in pending:
+            await job_options.scheme_slots.acquire()
+            result, batches = await plan_scheme_task(scheme_file, job_options)
+            results.append(result)
+            if not batches:
+                job_options.scheme_slots.release()
+            for batch in batches:
+                kind, cost = get_batch_cost(batch)
+                queue.put_nowait(((-kind, -cost), next(counter), batch))
+
+    async def worker():
+        while True:
+            _, _, batch = await queue.get()
+            if batch is None:
+                return
+            results.append(await build_batch_task(batch, job_options))
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(job_options.max_renders)]
+    try:
+        planner_count = min(job_options.max_renders, len(scheme_files))
+        await asyncio.gather(*[planner() for _ in range(planner_count)])
+    finally:
+        # sorted after all batches, so workers only stop once they are done
+        for _ in workers:
+            queue.put_nowait(((1, 0), next(counter), None))
+    await asyncio.gather(*workers)
+    return results
 
 
-def build(templates=None, schemes=None, base_output_dir=None, verbose=False):
-    """Main build function to initiate building process."""
-    template_dirs = templates or get_template_dirs()
-    scheme_files = get_scheme_files(schemes)
+def build(
+    templates=None,
+    schemes=None,
+    base_output_dir=None,
+    verbose=False,
+    force=False,
+    jobs=1,
+    max_renders=None,
+    max_open_files=MAX_OPEN_FILES,
+    archive=None,
+    archive_format=None,
+    shard=None,
+):
+    """Main build function to initiate building process. $templates is a list
+    of template group paths, each optionally followed by "##" and the name of
+    a single sub-template to build (see get_template_selection), and
+    $schemes a list of scheme patterns. Unless $force is set, only outputs
+    whose inputs changed since the last build are rebuilt. If $jobs is
+    greater than 1, rendering is spread across that many processes; 0 uses
+    one process per CPU. $max_renders limits the number of schemes being
+    loaded and built concurrently (by default twice the number of processes,
+    but at least MAX_RENDERS) and $max_open_files the number of output files
+    open at once. Outputs of the loaded schemes are built most expensive
+    first, estimated from the render times recorded in the manifest by
+    previous builds. If $archive is set, all outputs are written to an archive at
+    that path (or to stdout if it's "-") instead of $base_output_dir; its
+    format is determined by $archive_format or the file extension. If $shard
+    is set to a tuple (K, N), only the outputs that get_shard assigns to
+    shard K of N are built; see merge_shards for combining the shards."""
+    index = ResourceIndex()
+    selection = get_template_selection(templates or index.template_dirs)
+    scheme_files = index.get_scheme_files(schemes)
     base_output_dir = base_output_dir or rel_to_cwd("output")
 
     # raise LookupError if there is not at least one template or scheme
     # to work with
-    if not template_dirs or not scheme_files:
+    if not selection or not scheme_files:
         raise LookupError
 
     # raise PermissionError if user has no write acces for $base_output_dir
-    try:
-        os.makedirs(base_output_dir)
-    except FileExistsError:
-        pass
+    if archive is None:
+        try:
+            os.makedirs(base_output_dir)
+        except FileExistsError:
+            pass
+
+        if not os.access(base_output_dir, os.W_OK | os.X_OK):
+            raise PermissionError
+
+    template_cache = get_template_cache()
+    templates = load_template_groups(selection, template_cache)
+    result = build_templates(
+        templates,
+        scheme_files,
+        base_output_dir,
+        verbose=verbose,
+        force=force,
+        jobs=jobs,
+        max_renders=max_renders,
+        max_open_files=max_open_files,
+        archive=archive,
+        archive_format=archive_format,
+        shard=shard,
+    )
+    # templates are parsed while building, so only save the cache now
+    template_cache.save()
+    # skipped template groups count as a warning
+    return result and len(templates) == len(selection)
 
-    if not os.access(base_output_dir, os.W_OK | os.X_OK):
-        raise PermissionError
 
-    templates = [TemplateGroup(path) for path in template_dirs]
+def iter_build(templates=None, schemes=None):
+    """Render colorschemes without writing anything to disk. Yield a tuple of
+    the template group name, sub-template name, scheme slug and rendered text
+    for each output as soon as it's rendered. Schemes are loaded one at a
+    time, so memory usage doesn't grow with the number of schemes. $templates
+    and $schemes restrict rendering like the arguments of build. Raise a
+    LookupError if there is not at least one template or scheme."""
+    index = ResourceIndex()
+    selection = get_template_selection(templates or index.template_dirs)
+    scheme_files = index.get_scheme_files(schemes)
+    if not selection or not scheme_files:
+        raise LookupError
+
+    template_groups = load_template_groups(selection)
+    for scheme_file in scheme_files:
+        scheme_slug = slugify(scheme_file)
+        try:
+            with profiling.phase("load_scheme", scheme=scheme_slug):
+                scheme = load_scheme(scheme_file)
+        except Exception as e:
+            verb_msg("{}: {!s}".format(scheme_file, e), lvl=2)
+            continue
+
+        context = SchemeContext(scheme, scheme_slug)
+        for temp_group in template_groups:
+            for temp, sub in temp_group.templates.items():
+                labels = {
+                    "scheme": scheme_slug,
+                    "template": "{}##{}".format(temp_group.name, temp),
+                }
+                with profiling.phase("render", **labels):
+                    rendered = sub["compiled"].render(context)
+                yield temp_group.name, temp, scheme_slug, rendered
+
+
+def build_templates(
+    templates,
+    scheme_files,
+    base_output_dir,
+    verbose=False,
+    force=False,
+    jobs=1,
+    max_renders=None,
+    max_open_files=MAX_OPEN_FILES,
+    archive=None,
+    archive_format=None,
+    shard=None,
+):
+    """Build $scheme_files using $templates, a list of already loaded
+    TemplateGroup instances, into $base_output_dir (which must exist unless
+    $archive is set). See build for the remaining arguments. Return True if
+    completed without warnings, otherwise False."""
+    if max_open_files < 1 or (max_renders is not None and max_renders < 1):
+        raise ValueError("Concurrency limits must be at least 1.")
+    if jobs < 0:
+        raise ValueError("The number of processes can't be negative.")
+    if shard is not None and archive is not None:
+        # archives have no manifest, so shards in them can't be merged
+        raise ValueError("Sharded builds can't be written to archives.")
+    archive_writer = None
+    if archive is not None:
+        try:
+            archive_writer = ArchiveWriter(archive, archive_format)
+        except OSError as e:
+            raise ValueError(
+                "Can't write archive {}: {}.".format(archive, e.strerror or e)
+            ) from e
+    scheme_store = SchemeStore()
+    if archive is None:
+        manifest = load_manifest(base_output_dir)
+        listings = prepare_output_dirs(base_output_dir, templates)
+    else:
+        manifest = {"version": MANIFEST_VERSION, "inputs": {}, "outputs": {}}
+        listings = {}
+    for temp_group in templates:
+        manifest["inputs"].update(temp_group.get_input_hashes())
+    if shard is None:
+        manifest.pop("shard", None)
+    else:
+        # outputs of other shards, e.g. from an earlier unsharded build into
+        # the same directory, must not end up in the merged manifest
+        manifest["shard"] = {
+            "index": shard[0],
+            "count": shard[1],
+            "inputs": get_inputs_digest(templates, scheme_files),
+        }
+        manifest["outputs"] = {
+            out: digest
+            for out, digest in manifest["outputs"].items()
+            if get_shard(out, shard[1]) == shard[0]
+        }
+
+    if jobs == 0:
+        jobs = os.cpu_count() or 1
+    max_renders = max_renders or max(MAX_RENDERS, 2 * jobs)
+    if jobs > 1:
+        # parse templates once here, with the cache, rather than in each
+        # worker process
+        for temp_group in templates:
+            temp_group.load()
+        pool = get_render_pool(jobs, templates)
+    else:
+        pool = None
 
     job_options = JobOptions(
-        base_output_dir=base_output_dir, templates=templates, verbose=verbose
+        base_output_dir=base_output_dir,
+        templates=templates,
+        template_map={temp_group.name: temp_group for temp_group in templates},
+        verbose=verbose,
+        force=force,
+        manifest=manifest,
+        pool=pool,
+        scheme_store=scheme_store,
+        listings=listings,
+        archive=archive_writer,
+        # keep stdout clean when it receives the archive
+        msg_file=sys.stderr if archive == "-" else sys.stdout,
+        max_renders=max_renders,
+        max_open_files=max_open_files,
+        shard=shard,
+        costs=get_unit_costs(templates, manifest.get("timings", {})),
+        contexts={},
+        remaining={},
+        render_times={},
+        stats={"rebuilt": 0, "skipped": 0, "new": 0, "updated": 0, "unchanged": 0},
     )
 
-    with compat_event_loop() as event_loop:
-        results = event_loop.run_until_complete(
-            build_scheduler(scheme_files, job_options)
-        )
+    try:
+        with compat_event_loop() as event_loop:
+            results = event_loop.run_until_complete(
+                build_scheduler(scheme_files, job_options)
+            )
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        if archive_writer is not None:
+            archive_writer.close()
 
-    print("Finished building process.")
+    if archive is None:
+        manifest["timings"] = get_render_timings(manifest, job_options.render_times)
+        with profiling.phase("manifest"):
+            write_manifest(base_output_dir, manifest, listings)
+    scheme_store.save()
+    scheme_store.close()
+
+    if archive is None:
+        summary = (
+            "Finished building process ({rebuilt} rebuilt, {skipped} skipped; "
+            "{new} new, {updated} updated, {unchanged} unchanged)."
+        )
+    else:
+        summary = "Finished building process ({rebuilt} rebuilt, {skipped} skipped)."
+    print(summary.format(**job_options.stats), file=job_options.msg_file)
     return all(results)
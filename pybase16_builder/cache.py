@@ -0,0 +1,76 @@
+import os
+import json
+from .shared import rel_to_cwd
+
+CACHE_DIR = ".pybase16-cache"
+CACHE_VERSION = 2
+
+
+class FileCache(object):
+    """Persistent cache of values derived from files, stored in the working
+    directory. Each entry maps a file path to a key identifying the state of
+    the file (e.g. its content hash) and the cached value. Values must be
+    serializable as JSON. Entries written with a different $version (e.g.
+    by another version of the code producing the values) are discarded."""
+
+    def __init__(self, name, version=None):
+        self.path = rel_to_cwd(CACHE_DIR, "{}.json".format(name))
+        self.version = [CACHE_VERSION, version]
+        self.entries = self._load()
+        self.changed = False
+
+    def _load(self):
+        """Return the entries stored in $self.path. If the file doesn't exist
+        or can't be used, return an empty dictionary instead."""
+        try:
+            with open(self.path, "r", encoding="utf-8") as file_:
+                data = json.load(file_)
+            version, entries = data["version"], data["entries"]
+        except Exception:
+            # a missing, corrupt or incompatible cache is simply rebuilt
+            return {}
+
+        if version != self.version or not isinstance(entries, dict):
+            return {}
+        return entries
+
+    def get(self, path, key):
+        """Return the value cached for $path if it was stored with $key.
+        Otherwise return None."""
+        try:
+            cached_key, value = self.entries[path]
+        except (KeyError, TypeError, ValueError):
+            return None
+        return value if cached_key == key else None
+
+    def set(self, path, key, value):
+        """Cache $value for $path under $key."""
+        self.entries[path] = [key, value]
+        self.changed = True
+
+    def prune(self):
+        """Remove entries for files that no longer exist."""
+        for path in [path for path in self.entries if not os.path.exists(path)]:
+            del self.entries[path]
+            self.changed = True
+
+    def save(self):
+        """Write the cache to disk if it changed. Failing to do so is not an
+        error as the cache can always be rebuilt."""
+        self.prune()
+        if not self.changed:
+            return
+
+        tmp_path = "{}.{}.tmp".format(self.path, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(tmp_path, "w", encoding="utf-8") as file_:
+                json.dump({"version": self.version, "entries": self.entries}, file_)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+        self.changed = False
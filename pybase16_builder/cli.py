@@ -1,9 +1,45 @@
+import os
 import sys
 import argparse
-from . import updater, builder, injector
+from . import updater, builder, injector, archive, profiling, watcher, store
 from .shared import rel_to_cwd, err_print
 
 
+def positive_int(value):
+    """Argument type for integers of at least 1."""
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError("{} is not a positive integer".format(value))
+    return number
+
+
+def non_negative_int(value):
+    """Argument type for integers of at least 0."""
+    try:
+        number = int(value)
+    except ValueError:
+        number = -1
+    if number < 0:
+        raise argparse.ArgumentTypeError(
+            "{} is not a non-negative integer".format(value)
+        )
+    return number
+
+
+def positive_float(value):
+    """Argument type for numbers greater than 0."""
+    try:
+        number = float(value)
+    except ValueError:
+        number = 0.0
+    if not number > 0:
+        raise argparse.ArgumentTypeError("{} is not a positive number".format(value))
+    return number
+
+
 def catch_keyboard_interrupt(func):
     """Decorator for catching KeyboardInterrupt and quitting gracefully."""
 
@@ -23,16 +59,46 @@ def build_mode(arg_namespace):
     temp_paths = [rel_to_cwd("templates", temp) for temp in custom_temps]
 
     try:
+        shard = None
+        if arg_namespace.shard is not None:
+            shard = builder.parse_shard(arg_namespace.shard)
+        if arg_namespace.watch:
+            if arg_namespace.archive:
+                raise ValueError("--watch can't be combined with --archive.")
+            if shard is not None:
+                raise ValueError("--watch can't be combined with --shard.")
+            watcher.watch(
+                interval=arg_namespace.watch_interval,
+                template_dirs=temp_paths,
+                schemes=arg_namespace.scheme,
+                base_output_dir=arg_namespace.output,
+                verbose=arg_namespace.verbose,
+                force=arg_namespace.force,
+                jobs=arg_namespace.jobs,
+                max_renders=arg_namespace.max_renders,
+                max_open_files=arg_namespace.max_open_files,
+            )
+            return
+
         result = builder.build(
             templates=temp_paths,
             schemes=arg_namespace.scheme,
             base_output_dir=arg_namespace.output,
             verbose=arg_namespace.verbose,
+            force=arg_namespace.force,
+            jobs=arg_namespace.jobs,
+            max_renders=arg_namespace.max_renders,
+            max_open_files=arg_namespace.max_open_files,
+            archive=arg_namespace.archive,
+            archive_format=arg_namespace.archive_format,
+            shard=shard,
         )
         # return with exit code 2 if there were any non-fatal incidents during
         sys.exit(0 if result else 2)
 
-    except (LookupError, PermissionError) as exception:
+    except (LookupError, PermissionError, ValueError) as exception:
+        if isinstance(exception, ValueError):
+            err_print(exception.args[0])
         if isinstance(exception, LookupError):
             err_print(
                 "Necessary resources for building not found in current "
@@ -40,15 +106,22 @@ def build_mode(arg_namespace):
             )
         if isinstance(exception, PermissionError):
             err_print("Lacking necessary access permissions for output directory.")
+    except OSError as exception:
+        # e.g. the disk holding the archive filled up while building
+        err_print("Error writing output: {}".format(exception))
 
 
 @catch_keyboard_interrupt
 def inject_mode(arg_namespace):
-    """Check command line arguments and run build function."""
+    """Check command line arguments and run inject function."""
     try:
-        injector.inject_into_files(arg_namespace.scheme, arg_namespace.file)
+        result = injector.inject_into_files(
+            arg_namespace.scheme, arg_namespace.file, jobs=arg_namespace.jobs
+        )
+        # return with exit code 2 if injecting into any of the files failed
+        sys.exit(0 if result else 2)
+
     except (
-        IndexError,
         FileNotFoundError,
         LookupError,
         PermissionError,
@@ -56,13 +129,7 @@ def inject_mode(arg_namespace):
         ValueError,
     ) as exception:
         if isinstance(exception, ValueError):
-            err_print(
-                "Pattern {} matches more than one scheme.".format(*arg_namespace.scheme)
-            )
-        elif isinstance(exception, IndexError):
-            err_print(
-                '"{}" has no valid injection marker lines.'.format(exception.args[0])
-            )
+            err_print(exception.args[0])
         elif isinstance(exception, FileNotFoundError):
             err_print(
                 'Lacking resource "{}" to complete operation.'.format(
@@ -86,13 +153,21 @@ def update_mode(arg_namespace):
     """Check command line arguments and run update function."""
     try:
         result = updater.update(
-            custom_sources=arg_namespace.custom, verbose=arg_namespace.verbose
+            custom_sources=arg_namespace.custom,
+            verbose=arg_namespace.verbose,
+            reclone=arg_namespace.reclone,
+            max_jobs=arg_namespace.jobs,
+            timeout=arg_namespace.timeout,
+            retries=arg_namespace.retries,
+            mirror_dir=arg_namespace.mirror_dir,
         )
         # return with exit code 2 if there were any non-fatal incidents during
         # update
         sys.exit(0 if result else 2)
 
-    except (PermissionError, FileNotFoundError) as exception:
+    except (PermissionError, FileNotFoundError, ValueError) as exception:
+        if isinstance(exception, ValueError):
+            err_print(exception.args[0])
         if isinstance(exception, PermissionError):
             err_print("No write permission for current working directory.")
         if isinstance(exception, FileNotFoundError):
@@ -102,9 +177,54 @@ def update_mode(arg_namespace):
             )
 
 
+@catch_keyboard_interrupt
+def merge_mode(arg_namespace):
+    """Check command line arguments and merge the output directories of a
+    sharded build."""
+    try:
+        os.makedirs(arg_namespace.output, exist_ok=True)
+        count = builder.merge_shards(arg_namespace.shard_dir, arg_namespace.output)
+        print(
+            "Merged {} shards ({} files).".format(len(arg_namespace.shard_dir), count)
+        )
+    except ValueError as exception:
+        err_print(exception.args[0])
+    except FileNotFoundError as exception:
+        err_print('Missing shard output "{}".'.format(exception.filename))
+    except PermissionError:
+        err_print("Lacking necessary access permissions for output directory.")
+
+
+@catch_keyboard_interrupt
+def schemes_mode(arg_namespace):
+    """Check command line arguments and list or show stored schemes."""
+    scheme_store = store.SchemeStore()
+    result = True
+    if arg_namespace.refresh:
+        result = builder.index_schemes(scheme_store)
+
+    if arg_namespace.action == "list":
+        rows = scheme_store.list_schemes()
+        if not rows:
+            err_print(
+                "No schemes stored yet. Run a build or use --refresh to add "
+                "all schemes in the current working directory."
+            )
+        print(store.format_scheme_list(rows))
+    else:
+        if not arg_namespace.slug:
+            err_print("Specify the slug of the scheme to show.")
+        matches = scheme_store.find(arg_namespace.slug)
+        if not matches:
+            err_print('No scheme "{}" stored.'.format(arg_namespace.slug))
+        print("\n\n".join(store.format_context(*match) for match in matches))
+    sys.exit(0 if result else 2)
+
+
 def run():
     arg_namespace = argparser.parse_args()
-    arg_namespace.func(arg_namespace)
+    with profiling.profile_command(arg_namespace.profile, arg_namespace.cprofile):
+        arg_namespace.func(arg_namespace)
 
 
 argparser = argparse.ArgumentParser(prog="pybase16")
@@ -122,6 +242,44 @@ update_parser.add_argument(
     const=True,
     help="update repositories but don't update source files",
 )
+update_parser.add_argument(
+    "-r",
+    "--reclone",
+    action="store_const",
+    const=True,
+    default=False,
+    help="delete existing repositories and clone them again instead of fetching updates",
+)
+update_parser.add_argument(
+    "-j",
+    "--jobs",
+    type=positive_int,
+    default=updater.MAX_GIT_JOBS,
+    metavar="N",
+    help="run at most N git processes at once (default: %(default)s)",
+)
+update_parser.add_argument(
+    "--timeout",
+    type=positive_float,
+    default=updater.GIT_TIMEOUT,
+    metavar="SECONDS",
+    help="give up on a repository after SECONDS (default: %(default)s)",
+)
+update_parser.add_argument(
+    "--retries",
+    type=non_negative_int,
+    default=updater.GIT_RETRIES,
+    metavar="N",
+    help="retry failed or timed out repositories up to N times (default: %(default)s)",
+)
+update_parser.add_argument(
+    "-m",
+    "--mirror-dir",
+    metavar="DIR",
+    help="keep bare mirrors of all repositories in DIR, which can be shared between working directories, and clone from them (default: ${})".format(
+        updater.MIRROR_DIR_ENV
+    ),
+)
 update_parser.add_argument(
     "-v", "--verbose", action="store_const", const=True, help="increase verbosity"
 )
@@ -133,12 +291,23 @@ build_parser.set_defaults(func=build_mode)
 build_parser.add_argument(
     "-o", "--output", help="specifiy a target directory for the build output"
 )
+build_parser.add_argument(
+    "-a",
+    "--archive",
+    metavar="PATH",
+    help="write the build output into an archive at PATH instead of a directory; use - for stdout",
+)
+build_parser.add_argument(
+    "--archive-format",
+    choices=sorted(archive.ARCHIVE_FORMATS),
+    help="archive format to use with --archive (default: derived from the file extension, tar for stdout)",
+)
 build_parser.add_argument(
     "-t",
     "--template",
     action="append",
     metavar="TEMP",
-    help="restrict operation to specific templates (must correspond to a directory in ./templates); can be specified more than once",
+    help="restrict operation to specific templates (must correspond to a directory in ./templates); use TEMP##SUB to select a single sub-template; can be specified more than once",
 )
 build_parser.add_argument(
     "-s",
@@ -146,6 +315,55 @@ build_parser.add_argument(
     action="append",
     help="restrict operation to specific schemes; (properly escaped) wildcards allowed",
 )
+build_parser.add_argument(
+    "-j",
+    "--jobs",
+    type=non_negative_int,
+    default=1,
+    metavar="N",
+    help="render schemes in N parallel processes; 0 uses one process per CPU",
+)
+build_parser.add_argument(
+    "--max-renders",
+    type=positive_int,
+    metavar="N",
+    help="load and build at most N schemes concurrently",
+)
+build_parser.add_argument(
+    "--max-open-files",
+    type=positive_int,
+    default=builder.MAX_OPEN_FILES,
+    metavar="N",
+    help="keep at most N output files open at once (default: %(default)s)",
+)
+build_parser.add_argument(
+    "-f",
+    "--force",
+    action="store_const",
+    const=True,
+    default=False,
+    help="rebuild all outputs, even those whose inputs haven't changed since the last build",
+)
+build_parser.add_argument(
+    "--shard",
+    metavar="K/N",
+    help="build only the K-th of N disjoint parts of the outputs, to be combined with the merge command",
+)
+build_parser.add_argument(
+    "-w",
+    "--watch",
+    action="store_const",
+    const=True,
+    default=False,
+    help="keep running and rebuild affected outputs whenever schemes or templates change",
+)
+build_parser.add_argument(
+    "--watch-interval",
+    type=float,
+    default=1.0,
+    metavar="SECONDS",
+    help="polling interval for --watch where inotify isn't available (default: %(default)s)",
+)
 build_parser.add_argument(
     "-v", "--verbose", action="store_const", const=True, help="increase verbosity"
 )
@@ -168,3 +386,61 @@ inject_parser.add_argument(
     required=True,
     help="select a scheme; allows for wildcards",
 )
+inject_parser.add_argument(
+    "-j",
+    "--jobs",
+    type=positive_int,
+    default=injector.INJECT_JOBS,
+    metavar="N",
+    help="inject into up to N files concurrently (default: %(default)s)",
+)
+
+merge_parser = subparsers.add_parser(
+    "merge", help="merge: combine the output directories of a sharded build"
+)
+merge_parser.set_defaults(func=merge_mode)
+merge_parser.add_argument(
+    "-o",
+    "--output",
+    required=True,
+    help="directory into which the shards are merged",
+)
+merge_parser.add_argument(
+    "shard_dir", nargs="+", help="output directory of one shard of the build"
+)
+
+schemes_parser = subparsers.add_parser(
+    "schemes",
+    help="schemes: list or show schemes stored by previous builds and injections",
+)
+schemes_parser.set_defaults(func=schemes_mode)
+schemes_parser.add_argument(
+    "action", choices=["list", "show"], help="list all schemes or show one"
+)
+schemes_parser.add_argument("slug", nargs="?", help="slug of the scheme to show")
+schemes_parser.add_argument(
+    "-r",
+    "--refresh",
+    action="store_const",
+    const=True,
+    default=False,
+    help="add or update all schemes in ./schemes first",
+)
+
+for parser in (
+    update_parser,
+    build_parser,
+    inject_parser,
+    merge_parser,
+    schemes_parser,
+):
+    parser.add_argument(
+        "--profile",
+        metavar="FILE",
+        help="record time spent per phase, scheme and template, write it to FILE as JSON and print a summary",
+    )
+    parser.add_argument(
+        "--cprofile",
+        metavar="FILE",
+        help="run the command under cProfile and dump the statistics to FILE",
+    )
@@ -1,105 +1,326 @@
+import os
 import re
-import pystache
-from . import builder
-from .shared import rel_to_cwd, get_yaml_dict
+import mmap
+import shutil
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from . import builder, profiling
+from .store import SchemeStore
+from .shared import get_yaml_dict, rel_to_cwd, verb_msg
 
-TEMP_NEEDLE = re.compile(r"^.*%%base16_template:([^%]+)%%$")
-TEMP_END_NEEDLE = re.compile(r"^.*%%base16_template_end%%$")
+INJECT_JOBS = 8
+# files at least this large are scanned through mmap instead of being read
+MMAP_THRESHOLD = 1024 * 1024
+MARKER_NEEDLE = re.compile(
+    rb"^[^\n]*%%base16_template(?::([^%\n]+)|(_end))%%\r?$", re.MULTILINE
+)
+
+# a marker block: the template it refers to and the byte offsets of the
+# content between its start and end line
+MarkerBlock = namedtuple("MarkerBlock", ["temp", "start", "end"])
+
+
+def split_temp(temp):
+    """Return a tuple of the template group and sub-template names the
+    marker string $temp refers to."""
+    try:
+        temp_base, temp_sub = temp.split("##")
+    except ValueError:
+        temp_base, temp_sub = (temp.strip("##"), "default")
+    return temp_base, temp_sub or "default"
+
+
+def get_marker_blocks(content):
+    """Return a list of MarkerBlock tuples for all complete marker blocks in
+    the bytes-like object $content, found in a single pass. Start lines
+    inside a block and end lines outside of one are ignored."""
+    blocks = []
+    open_block = None
+    for match in MARKER_NEEDLE.finditer(content):
+        if open_block is None:
+            if match.group(1) is not None:
+                temp = match.group(1).decode("utf-8").strip()
+                open_block = (temp, match.end() + 1)
+        elif match.group(2) is not None:
+            blocks.append(MarkerBlock(open_block[0], open_block[1], match.start()))
+            open_block = None
+    return blocks
 
 
 class Recipient:
-    """Represents a file into which a base16 scheme is to be injected."""
+    """Represents a file into which a base16 scheme is to be injected. A file
+    can contain several marker blocks, each referring to its own
+    template."""
 
     def __init__(self, path):
         self.path = path
         self.content = self._get_file_content(self.path)
-        self.temp = self._get_temp(self.content)
+        self.blocks = get_marker_blocks(self.content)
+        if not self.blocks:
+            raise IndexError(self.path)
+        self.temp = self.blocks[0].temp
+        self.injections = {}
 
     def _get_file_content(self, path):
-        """Return a string representation file content at $path."""
-        with open(path, "r", encoding="utf-8") as file_:
-            content = file_.read()
-        return content
-
-    def _get_temp(self, content):
-        """Get the string that points to a specific base16 scheme."""
-        temp = None
-        for line in content.split("\n"):
-
-            # make sure there's both start and end line
-            if not temp:
-                match = TEMP_NEEDLE.match(line)
-                if match:
-                    temp = match.group(1).strip()
-                    continue
-            else:
-                match = TEMP_END_NEEDLE.match(line)
-                if match:
-                    return temp
+        """Return the content of the file at $path as bytes, or as a
+        read-only mmap if the file is at least MMAP_THRESHOLD bytes large."""
+        with open(path, "rb") as file_:
+            if os.fstat(file_.fileno()).st_size >= MMAP_THRESHOLD:
+                return mmap.mmap(file_.fileno(), 0, access=mmap.ACCESS_READ)
+            return file_.read()
+
+    def get_colorscheme(self, scheme_file, batch=None, block=0):
+        """Return a string object with the colorscheme that is to be inserted
+        into marker block number $block. Pass an InjectionBatch for
+        $scheme_file as $batch to share loaded schemes, templates and
+        rendered blocks between recipients."""
+        if batch is None:
+            batch = InjectionBatch(scheme_file)
+            try:
+                return batch.render(self.blocks[block].temp, self.path)
+            finally:
+                batch.save()
+        return batch.render(self.blocks[block].temp, self.path)
 
-        raise IndexError(self.path)
+    def inject_scheme(self, b16_scheme, block=0):
+        """Inject string $b16_scheme into marker block number $block. The
+        file content itself is only changed by write."""
+        self.injections[block] = b16_scheme.encode("utf-8") + b"\n"
 
-    def get_colorscheme(self, scheme_file):
-        """Return a string object with the colorscheme that is to be
-        inserted."""
-        scheme = get_yaml_dict(scheme_file)
-        scheme_slug = builder.slugify(scheme_file)
-        builder.format_scheme(scheme, scheme_slug)
+    def is_changed(self):
+        """Return True if any injected block differs from the current content
+        of its marker block."""
+        with memoryview(self.content) as view:
+            return any(
+                view[self.blocks[num].start : self.blocks[num].end] != injection
+                for num, injection in self.injections.items()
+            )
+
+    def write(self):
+        """Write content back to file, splicing in all injected blocks. If the
+        file is a symlink, the file it points to is written. The file is
+        replaced atomically, keeping its mode and owner; where the owner
+        can't be kept, it's rewritten in place instead. It's left untouched
+        if none of the blocks changed. Return True if the file was
+        written."""
+        if not self.is_changed():
+            self.close()
+            return False
 
+        with profiling.phase("write", file=self.path):
+            target = os.path.realpath(self.path)
+            try:
+                if not self._replace(target):
+                    self._write_in_place(target)
+            finally:
+                self.close()
+        return True
+
+    def _iter_chunks(self, view):
+        """Yield the parts of the new file content, taken from the memoryview
+        $view of the current content and the injected blocks."""
+        offset = 0
+        for num, block in enumerate(self.blocks):
+            if num in self.injections:
+                yield view[offset : block.start]
+                yield self.injections[num]
+                offset = block.end
+        yield view[offset:]
+
+    def _replace(self, target):
+        """Write the new content to a temporary file next to $target and
+        rename it to $target. Return False without changing anything if the
+        temporary file can't be created or given the owner and group of
+        $target."""
+        stat = os.stat(target)
+        tmp_path = os.path.join(
+            os.path.dirname(target), ".{}.tmp".format(os.path.basename(target))
+        )
         try:
-            temp_base, temp_sub = self.temp.split("##")
-        except ValueError:
-            temp_base, temp_sub = (self.temp.strip("##"), "default")
+            file_ = open(tmp_path, "wb")
+        except PermissionError:
+            return False
 
-        temp_path = rel_to_cwd("templates", temp_base)
-        temp_group = builder.TemplateGroup(temp_path)
         try:
-            single_temp = temp_group.templates[temp_sub]
+            with file_, memoryview(self.content) as view:
+                for chunk in self._iter_chunks(view):
+                    file_.write(chunk)
+            shutil.copymode(target, tmp_path)
+            tmp_stat = os.stat(tmp_path)
+            if (tmp_stat.st_uid, tmp_stat.st_gid) != (stat.st_uid, stat.st_gid):
+                try:
+                    os.chown(tmp_path, stat.st_uid, stat.st_gid)
+                except PermissionError:
+                    os.remove(tmp_path)
+                    return False
+            os.replace(tmp_path, target)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        return True
+
+    def _write_in_place(self, target):
+        """Overwrite the content of $target with the new content."""
+        with memoryview(self.content) as view:
+            data = b"".join(self._iter_chunks(view))
+        # the content may be memory-mapped from $target
+        self.close()
+        with open(target, "r+b") as file_:
+            file_.write(data)
+            file_.truncate()
+
+    def close(self):
+        """Release the file content if it's memory-mapped."""
+        if isinstance(self.content, mmap.mmap):
+            self.content.close()
+
+
+class InjectionBatch(object):
+    """Shared state for injecting the scheme at $scheme_file into several
+    files. The scheme is loaded once, sub-templates are only loaded when a
+    recipient asks for them and each rendered block is kept so that it's
+    rendered at most once per template##sub."""
+
+    def __init__(self, scheme_file):
+        self.scheme_file = scheme_file
+        self.scheme_slug = builder.slugify(scheme_file)
+        with profiling.phase("load_scheme", scheme=self.scheme_slug):
+            scheme_store = SchemeStore()
+            try:
+                self.context = builder.get_scheme_context(scheme_file, scheme_store)
+                scheme_store.save()
+            finally:
+                scheme_store.close()
+        self.template_cache = builder.get_template_cache()
+        self.configs = {}
+        self.rendered = {}
+        # recipients may be processed in several threads at once
+        self.lock = threading.Lock()
+
+    def get_config(self, temp_base):
+        """Return the config.yaml dictionary of template group $temp_base."""
+        try:
+            return self.configs[temp_base]
         except KeyError:
-            raise FileNotFoundError(None, None, self.path + " (sub-template)")
-
-        colorscheme = pystache.render(single_temp["parsed"], scheme)
-        return colorscheme
-
-    def inject_scheme(self, b16_scheme):
-        """Inject string $b16_scheme into self.content."""
-        # correctly formatted start and end of block should have already been
-        # ascertained by _get_temp
-        content_lines = self.content.split("\n")
-        b16_scheme_lines = b16_scheme.split("\n")
-        start_line = None
-        for num, line in enumerate(content_lines):
-            if not start_line:
-                match = TEMP_NEEDLE.match(line)
-                if match:
-                    start_line = num + 1
-            else:
-                match = TEMP_END_NEEDLE.match(line)
-                if match:
-                    end_line = num
-
-        # put lines back together
-        new_content_lines = (
-            content_lines[0:start_line] + b16_scheme_lines + content_lines[end_line:]
+            config_path = rel_to_cwd("templates", temp_base, "templates", "config.yaml")
+            if not os.path.isfile(config_path):
+                raise FileNotFoundError(None, None, config_path)
+            config = get_yaml_dict(config_path)
+            self.configs[temp_base] = config
+            return config
+
+    def render(self, temp, path=None):
+        """Return the colorscheme block for the marker string $temp, found
+        in the file at $path."""
+        temp_base, temp_sub = split_temp(temp)
+        temp = "{}##{}".format(temp_base, temp_sub)
+        with self.lock:
+            try:
+                return self.rendered[temp]
+            except KeyError:
+                pass
+            colorscheme = self._render(temp_base, temp_sub, path)
+            self.rendered[temp] = colorscheme
+            return colorscheme
+
+    def _render(self, temp_base, temp_sub, path):
+        """Load and render sub-template $temp_sub of template group
+        $temp_base."""
+        if temp_sub not in self.get_config(temp_base):
+            raise FileNotFoundError(None, None, "{} (sub-template)".format(path))
+        mustache_path = rel_to_cwd(
+            "templates", temp_base, "templates", "{}.mustache".format(temp_sub)
         )
-        self.content = "\n".join(new_content_lines)
+        with profiling.phase("load_templates", template_group=temp_base):
+            compiled, _ = builder.get_compiled_template(
+                mustache_path, self.template_cache
+            )
 
-    def write(self):
-        """Write content back to file."""
-        with open(self.path, "w", encoding="utf-8") as file_:
-            file_.write(self.content)
+        temp = "{}##{}".format(temp_base, temp_sub)
+        with profiling.phase("render", scheme=self.scheme_slug, template=temp):
+            return compiled.render(self.context)
+
+    def save(self):
+        """Save the template cache."""
+        self.template_cache.save()
+
+
+def inject_file(path, batch):
+    """Inject the scheme of InjectionBatch $batch into all marker blocks of
+    the file at $path. Return "updated" if the file was rewritten and
+    "unchanged" if it already contained the scheme."""
+    rec = Recipient(path)
+    try:
+        for num, block in enumerate(rec.blocks):
+            rec.inject_scheme(batch.render(block.temp, path), block=num)
+    except BaseException:
+        rec.close()
+        raise
+    return "updated" if rec.write() else "unchanged"
 
 
-def inject_into_files(scheme, files):
-    """Inject $scheme into list $files."""
+def get_error_message(path, exception):
+    """Return a message describing why injecting into $path failed with
+    $exception."""
+    if isinstance(exception, IndexError):
+        return '"{}" has no valid injection marker lines.'.format(path)
+    if isinstance(exception, IsADirectoryError):
+        return '"{}" is a directory.'.format(path)
+    if isinstance(exception, FileNotFoundError):
+        return 'Lacking resource "{}" to complete operation.'.format(
+            exception.filename or path
+        )
+    if isinstance(exception, PermissionError):
+        return 'No write permission for "{}".'.format(path)
+    return "{}: {!s}".format(path, exception)
+
+
+def inject_into_files(scheme, files, jobs=INJECT_JOBS):
+    """Inject $scheme into list $files, processing up to $jobs files
+    concurrently. Paths that refer to the same file (e.g. through symlinks)
+    are only injected into once. A file that can't be injected into doesn't
+    stop the others; the outcome for each file is printed. Return True if
+    all files were injected into successfully."""
+    if jobs < 1:
+        raise ValueError("The number of concurrent files must be at least 1.")
     scheme_files = builder.get_scheme_files(scheme)
     if len(scheme_files) == 0:
         raise FileNotFoundError(None, None, scheme)
     if len(scheme_files) > 1:
-        raise ValueError
+        raise ValueError("Pattern {} matches more than one scheme.".format(*scheme))
+
+    def try_inject_file(path):
+        try:
+            return inject_file(path, batch)
+        except Exception as e:
+            return e
+
+    # concurrent writes to the same file would clobber each other
+    targets = {}
+    for path in files:
+        targets.setdefault(os.path.realpath(path), path)
+    files = list(targets.values())
+
+    batch = InjectionBatch(*scheme_files)
+    stats = {"updated": 0, "unchanged": 0, "failed": 0}
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            for path, outcome in zip(files, pool.map(try_inject_file, files)):
+                if isinstance(outcome, Exception):
+                    verb_msg(get_error_message(path, outcome), lvl=2)
+                    stats["failed"] += 1
+                    continue
+                print("{}: {}".format(path, outcome))
+                stats[outcome] += 1
+    finally:
+        batch.save()
 
-    for file_ in files:
-        rec = Recipient(file_)
-        colorscheme = rec.get_colorscheme(*scheme_files)
-        rec.inject_scheme(colorscheme)
-        rec.write()
+    print(
+        "Finished injection ({updated} updated, {unchanged} unchanged, "
+        "{failed} failed).".format(**stats)
+    )
+    return stats["failed"] == 0
@@ -0,0 +1,164 @@
+import sys
+import json
+import time
+import threading
+import cProfile
+from contextlib import contextmanager
+
+# profiler that phases are currently recorded with; None if profiling is off
+_active = None
+
+
+class Profiler(object):
+    """Collects wall time and call counts per phase (e.g. "load_scheme" or
+    "render") as well as the time spent on individual items such as schemes
+    and templates. Functions added with add_hook are called with the phase
+    name, the elapsed time in seconds and the item labels of each recorded
+    phase."""
+
+    def __init__(self):
+        self.phases = {}
+        self.items = {}
+        self.hooks = []
+        self.lock = threading.Lock()
+        self.start_time = time.perf_counter()
+
+    def add_hook(self, func):
+        """Call $func(name, elapsed, labels) for every recorded phase."""
+        self.hooks.append(func)
+
+    def record(self, name, elapsed, **labels):
+        """Record that phase $name took $elapsed seconds. Keyword arguments
+        label the items the phase worked on, e.g. scheme="ocean"."""
+        with self.lock:
+            stats = self.phases.setdefault(name, [0, 0.0])
+            stats[0] += 1
+            stats[1] += elapsed
+            for kind, item in labels.items():
+                if item is None:
+                    continue
+                kind_items = self.items.setdefault(kind, {})
+                kind_items[item] = kind_items.get(item, 0.0) + elapsed
+        for hook in self.hooks:
+            hook(name, elapsed, labels)
+
+    def get_report(self, top=10):
+        """Return a dictionary with the total wall time, the time and call
+        count of each phase and the $top slowest items of each kind."""
+        return {
+            "wall_time": time.perf_counter() - self.start_time,
+            "phases": {
+                name: {"calls": calls, "time": total}
+                for name, (calls, total) in sorted(self.phases.items())
+            },
+            "slowest": {
+                kind: sorted(kind_items.items(), key=lambda i: i[1], reverse=True)[
+                    :top
+                ]
+                for kind, kind_items in sorted(self.items.items())
+            },
+        }
+
+
+class Phase(object):
+    """Context manager recording the time spent in its body as phase $name
+    of the active profiler."""
+
+    __slots__ = ("name", "labels", "start")
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        if _active is not None:
+            _active.record(self.name, time.perf_counter() - self.start, **self.labels)
+
+
+class NullPhase(object):
+    """Context manager that does nothing, used while profiling is off."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+NULL_PHASE = NullPhase()
+
+
+def phase(name, **labels):
+    """Return a context manager recording its body as phase $name, labelled
+    with $labels, if profiling is active."""
+    if _active is None:
+        return NULL_PHASE
+    return Phase(name, labels)
+
+
+def record(name, elapsed, **labels):
+    """Record a phase measured elsewhere (e.g. in another process) if
+    profiling is active."""
+    if _active is not None:
+        _active.record(name, elapsed, **labels)
+
+
+def is_active():
+    """Return True if phases are currently being recorded."""
+    return _active is not None
+
+
+def start(profiler=None):
+    """Start recording phases with $profiler (or a new Profiler) and return
+    it."""
+    global _active
+    _active = profiler or Profiler()
+    return _active
+
+
+def stop():
+    """Stop recording phases and return the profiler that was active."""
+    global _active
+    profiler, _active = _active, None
+    return profiler
+
+
+def format_summary(report):
+    """Return a human readable summary of $report."""
+    lines = ["Total wall time: {:.3f}s".format(report["wall_time"]), "", "Phases:"]
+    for name, stats in report["phases"].items():
+        lines.append(
+            "  {:<20} {:>8.3f}s {:>8} calls".format(name, stats["time"], stats["calls"])
+        )
+    for kind, items in report["slowest"].items():
+        lines.extend(["", "Slowest ({}):".format(kind)])
+        lines.extend("  {:>8.3f}s {}".format(elapsed, item) for item, elapsed in items)
+    return "\n".join(lines)
+
+
+@contextmanager
+def profile_command(report_path=None, cprofile_path=None):
+    """Profile the body of the with statement. If $report_path is set, phases
+    are recorded and written to it as JSON, and a summary is printed to
+    stderr. If $cprofile_path is set, the body is also run under cProfile and
+    the statistics are dumped to that path."""
+    profiler = start() if report_path else None
+    cprofiler = cProfile.Profile() if cprofile_path else None
+    if cprofiler is not None:
+        cprofiler.enable()
+    try:
+        yield profiler
+    finally:
+        if cprofiler is not None:
+            cprofiler.disable()
+            cprofiler.dump_stats(cprofile_path)
+        if profiler is not None:
+            stop()
+            report = profiler.get_report()
+            with open(report_path, "w", encoding="utf-8") as file_:
+                json.dump(report, file_, indent=2)
+            print(format_summary(report), file=sys.stderr)
@@ -0,0 +1,127 @@
+import html
+import pystache
+
+# node types of a pystache parse tree that can be compiled; anything else
+# (sections, inverted sections, partials) is left to pystache
+SKIPPED_NODES = {"_CommentNode", "_ChangeNode"}
+VARIABLE_NODES = {"_EscapeNode": True, "_LiteralNode": False}
+
+# bump whenever the output of compile_parse_tree changes, so cached parts
+# produced by an older version are discarded
+RENDERER_VERSION = 1
+
+
+class Fallback(Exception):
+    """Raised if a template can't be rendered by a CompiledTemplate."""
+
+
+class CompiledTemplate(object):
+    """A template compiled from a pystache ParsedTemplate into a flat list of
+    literal strings and variable lookups. Templates that use features other
+    than plain variable substitution are rendered by pystache instead."""
+
+    def __init__(self, parsed):
+        self._parsed = parsed
+        self._text = None
+        try:
+            self.parts = compile_parse_tree(parsed._parse_tree)
+        except Fallback:
+            self.parts = None
+
+    @classmethod
+    def from_parts(cls, text, parts):
+        """Return a CompiledTemplate for the template source $text that has
+        already been compiled into $parts (None if it can't be compiled).
+        $text is only parsed once pystache has to render the template."""
+        template = cls.__new__(cls)
+        template._parsed = None
+        template._text = text
+        template.parts = parts if parts is None else tuple(map(tuple, parts))
+        return template
+
+    @property
+    def parsed(self):
+        """The pystache ParsedTemplate the template is based on."""
+        if self._parsed is None:
+            self._parsed = pystache.parse(self._text)
+        return self._parsed
+
+    @property
+    def compiled(self):
+        """Whether the template can be rendered without pystache."""
+        return self.parts is not None
+
+    @property
+    def variables(self):
+        """The set of variables the template refers to, or None if it's
+        rendered by pystache, which may look up any variable."""
+        if self.parts is None:
+            return None
+        return {key for literal, key, escape in self.parts if key is not None}
+
+    def render(self, context):
+        """Return the template rendered with the dictionary $context."""
+        if self.parts is None:
+            return pystache.render(self.parsed, context)
+
+        chunks = []
+        append = chunks.append
+        try:
+            for literal, key, escape in self.parts:
+                append(literal)
+                if key is None:
+                    continue
+                value = context[key] if key in context else ""
+                if not isinstance(value, str):
+                    if callable(value):
+                        # lambdas need to be rendered by pystache
+                        raise Fallback(key)
+                    value = str(value)
+                append(html.escape(value, quote=True) if escape else value)
+        except Fallback:
+            return pystache.render(self.parsed, context)
+        return "".join(chunks)
+
+
+def compile_parse_tree(parse_tree):
+    """Return a tuple of (literal, key, escape) tuples from $parse_tree.
+    $literal precedes the variable $key, which is None for trailing text.
+    Raise Fallback if $parse_tree contains nodes that can't be compiled."""
+    parts = []
+    literal = []
+    for node in parse_tree:
+        if isinstance(node, str):
+            literal.append(node)
+            continue
+
+        node_type = type(node).__name__
+        if node_type in SKIPPED_NODES:
+            continue
+        # dotted names and the implicit iterator require context stack
+        # semantics
+        if node_type not in VARIABLE_NODES or "." in node.key:
+            raise Fallback(node_type)
+
+        parts.append(("".join(literal), node.key, VARIABLE_NODES[node_type]))
+        literal = []
+
+    if literal:
+        parts.append(("".join(literal), None, False))
+    return tuple(parts)
+
+
+def compare_renderers(templates, contexts):
+    """Render each sub-template of the TemplateGroup instances in $templates
+    with each scheme context in $contexts, a dictionary mapping scheme slugs
+    to formatted schemes, both with the compiled template and with pystache.
+    Return a list of (template group name, sub-template name, scheme slug)
+    tuples for which the output differs."""
+    mismatches = []
+    for temp_group in templates:
+        for temp, sub in temp_group.templates.items():
+            for slug, context in contexts.items():
+                compiled = sub["compiled"].render(context).encode("utf-8")
+                reference = pystache.render(sub["parsed"], context).encode("utf-8")
+                if compiled != reference:
+                    mismatches.append((temp_group.name, temp, slug))
+    return mismatches
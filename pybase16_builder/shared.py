@@ -1,10 +1,14 @@
 import os
 import sys
 import asyncio
+import hashlib
 import yaml
 from collections import namedtuple
 from contextlib import contextmanager
 
+# use libyaml bindings if available
+YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
 
 class JobOptions:
     """Container for options related to job processing"""
@@ -46,12 +50,21 @@ def get_yaml_dict(yaml_file):
     doesn't exist, return an empty dict instead."""
     try:
         with open(yaml_file, "r", encoding="utf-8") as file_:
-            yaml_dict = yaml.safe_load(file_.read()) or {}
+            yaml_dict = yaml.load(file_.read(), Loader=YamlLoader) or {}
         return yaml_dict
     except FileNotFoundError:
         return {}
 
 
+def get_file_hash(path):
+    """Return the hex digest of the SHA-256 hash of the content of $path."""
+    hash_ = hashlib.sha256()
+    with open(path, "rb") as file_:
+        for chunk in iter(lambda: file_.read(65536), b""):
+            hash_.update(chunk)
+    return hash_.hexdigest()
+
+
 def err_print(msg, exit_code=1):
     """Print $msg and exit with $exit_code."""
     print(msg, file=sys.stderr)
@@ -0,0 +1,126 @@
+import os
+import json
+import sqlite3
+from .cache import CACHE_DIR
+from .shared import rel_to_cwd
+
+STORE_NAME = "schemes.sqlite"
+# increase whenever the table layout or the format of stored contexts changes
+STORE_VERSION = 1
+
+
+class SchemeStore(object):
+    """Persistent store of fully formatted scheme render contexts, kept in a
+    SQLite database in the cache folder of the working directory. Each entry
+    is keyed by the path of the scheme file and the hash of its content; the
+    slug, name and author are stored alongside so schemes can be looked up
+    and listed without reading any scheme files."""
+
+    def __init__(self, path=None):
+        self.path = path or rel_to_cwd(CACHE_DIR, STORE_NAME)
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.connection = self._connect(self.path)
+        except (OSError, sqlite3.Error):
+            # the store can always be rebuilt, so work without persisting it
+            self.connection = self._connect(":memory:")
+
+    def _connect(self, path):
+        """Return a connection to the database at $path, (re)creating the
+        schemes table if it doesn't match STORE_VERSION."""
+        connection = sqlite3.connect(path, timeout=30)
+        version = connection.execute("PRAGMA user_version").fetchone()[0]
+        with connection:
+            if version != STORE_VERSION:
+                connection.execute("DROP TABLE IF EXISTS schemes")
+                connection.execute("PRAGMA user_version = {}".format(STORE_VERSION))
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS schemes ("
+                "path TEXT PRIMARY KEY, hash TEXT NOT NULL, slug TEXT NOT NULL, "
+                "name TEXT, author TEXT, context TEXT NOT NULL)"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS schemes_slug ON schemes (slug)"
+            )
+        return connection
+
+    def get(self, path, hash_):
+        """Return the context stored for the scheme file at $path if it was
+        stored with content hash $hash_. Otherwise return None."""
+        row = self.connection.execute(
+            "SELECT context FROM schemes WHERE path = ? AND hash = ?", (path, hash_)
+        ).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def set(self, path, hash_, context):
+        """Store $context, a formatted scheme context as returned by
+        SchemeContext.to_dict, for the scheme file at $path with content
+        hash $hash_."""
+        self.connection.execute(
+            "INSERT OR REPLACE INTO schemes VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                path,
+                hash_,
+                context["scheme-slug"],
+                context["scheme-name"],
+                context["scheme-author"],
+                json.dumps(context, separators=(",", ":")),
+            ),
+        )
+
+    def find(self, slug):
+        """Return a list of (path, context) tuples of all stored schemes
+        with slug $slug."""
+        rows = self.connection.execute(
+            "SELECT path, context FROM schemes WHERE slug = ? ORDER BY path", (slug,)
+        )
+        return [(path, json.loads(context)) for path, context in rows]
+
+    def list_schemes(self):
+        """Return a list of (slug, name, author, path) tuples of all stored
+        schemes, ordered by slug."""
+        return self.connection.execute(
+            "SELECT slug, name, author, path FROM schemes ORDER BY slug, path"
+        ).fetchall()
+
+    def load_all(self):
+        """Return a dictionary mapping the paths of all stored schemes to
+        their contexts."""
+        rows = self.connection.execute("SELECT path, context FROM schemes")
+        return {path: json.loads(context) for path, context in rows}
+
+    def prune(self):
+        """Remove entries for files that no longer exist."""
+        rows = self.connection.execute("SELECT path FROM schemes").fetchall()
+        missing = [(path,) for path, in rows if not os.path.exists(path)]
+        self.connection.executemany("DELETE FROM schemes WHERE path = ?", missing)
+
+    def save(self):
+        """Prune the store and commit all changes. Failing to do so is not
+        an error as the store can always be rebuilt."""
+        try:
+            self.prune()
+            self.connection.commit()
+        except sqlite3.Error:
+            self.connection.rollback()
+
+    def close(self):
+        self.connection.close()
+
+
+def format_scheme_list(rows):
+    """Return a table of the schemes in $rows, as returned by
+    SchemeStore.list_schemes."""
+    width = max(len(slug) for slug, _, _, _ in rows)
+    return "\n".join(
+        "{:<{}}  {} by {}".format(slug, width, name, author)
+        for slug, name, author, _ in rows
+    )
+
+
+def format_context(path, context):
+    """Return all variables of the scheme context $context of the scheme
+    file at $path, one per line."""
+    lines = ["# {}".format(path)]
+    lines.extend("{}: {}".format(key, context[key]) for key in sorted(context))
+    return "\n".join(lines)
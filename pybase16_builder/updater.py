@@ -1,8 +1,29 @@
 import os
 import sys
+import time
 import shutil
 import asyncio
-from .shared import get_yaml_dict, rel_to_cwd, verb_msg, compat_event_loop
+import hashlib
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+from . import profiling
+from .shared import (
+    get_yaml_dict,
+    rel_to_cwd,
+    verb_msg,
+    compat_event_loop,
+    JobOptions,
+)
+
+MAX_GIT_JOBS = 16
+GIT_TIMEOUT = 300
+GIT_RETRIES = 2
+# seconds to wait before the first retry; doubled for each further one
+RETRY_DELAY = 1.0
+MIRROR_DIR_ENV = "PYBASE16_MIRROR_DIR"
 
 
 def write_sources_file():
@@ -18,43 +39,259 @@ def write_sources_file():
         file_.write(file_content)
 
 
+async def run_git(*args, cwd=None):
+    """Run git with $args in $cwd and return a tuple of its return code,
+    stdout and stderr (both decoded)."""
+    proc_env = os.environ.copy()
+    proc_env["GIT_TERMINAL_PROMPT"] = "0"
+    git_proc = await asyncio.create_subprocess_exec(
+        "git",
+        *args,
+        cwd=cwd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        env=proc_env
+    )
+    try:
+        stdout, stderr = await git_proc.communicate()
+    except asyncio.CancelledError:
+        # don't leave git running after a timeout
+        git_proc.kill()
+        await git_proc.wait()
+        raise
+    return (
+        git_proc.returncode,
+        stdout.decode("utf-8", "replace"),
+        stderr.decode("utf-8", "replace"),
+    )
+
+
 async def git_clone(git_url, path, verbose=False):
-    """Clone git repository at $git_url to $path. Return True if succesful,
-    otherwise False."""
+    """Clone the default branch of git repository at $git_url to $path,
+    without its history. Return True if succesful, otherwise False."""
+    with profiling.phase("clone", repo=git_url):
+        return await _git_clone(git_url, path, verbose)
+
+
+async def _git_clone(git_url, path, verbose=False):
     if verbose:
         print("Cloning {}...".format(git_url))
-    if os.path.exists(os.path.join(path, ".git")):
-        # get rid of local repo if it already exists
-        shutil.rmtree(path)
-
     os.makedirs(path, exist_ok=True)
 
-    proc_env = os.environ.copy()
-    proc_env["GIT_TERMINAL_PROMPT"] = "0"
-    git_proc = await asyncio.create_subprocess_exec(
-        "git", "clone", git_url, path, stderr=asyncio.subprocess.PIPE, env=proc_env
-    )
-    stdout, stderr = await git_proc.communicate()
+    try:
+        returncode, _, stderr = await run_git(
+            "clone", "--depth", "1", "--single-branch", git_url, path
+        )
+    except asyncio.CancelledError:
+        # git only clones into empty directories, so everything in $path is
+        # left over from the interrupted clone
+        shutil.rmtree(path, ignore_errors=True)
+        raise
 
-    if git_proc.returncode != 0:
+    if returncode != 0:
         # remove created directory if it's empty
         try:
             os.rmdir(path)
         except OSError:
             pass
 
-        verb_msg("{}:\n{}".format(git_url, stderr.decode("utf-8")))
+        verb_msg("{}:\n{}".format(git_url, stderr))
         return False
     elif verbose:
         print("Cloned {}".format(git_url))
     return True
 
 
-async def git_clone_scheduler(yaml_file, base_dir, verbose=False):
-    """Create task list for clone jobs and run them asynchronously."""
-    jobs = generate_jobs_from_yaml(yaml_file, base_dir)
-    task_list = [git_clone(*args_, verbose=verbose) for args_ in jobs]
-    return await asyncio.gather(*task_list)
+async def git_fetch(git_url, path, verbose=False):
+    """Update the existing clone at $path to the latest commit of the
+    default branch of $git_url, discarding local changes. Return "updated"
+    or "unchanged" if successful and None otherwise."""
+    with profiling.phase("fetch", repo=git_url):
+        return await _git_fetch(git_url, path, verbose)
+
+
+async def _git_fetch(git_url, path, verbose=False):
+    if verbose:
+        print("Fetching {}...".format(git_url))
+    returncode, old_head, stderr = await run_git("rev-parse", "HEAD", cwd=path)
+    if returncode == 0:
+        for args in (
+            ("remote", "set-url", "origin", git_url),
+            ("fetch", "--depth", "1", "origin", "HEAD"),
+            ("reset", "--hard", "FETCH_HEAD"),
+        ):
+            returncode, _, stderr = await run_git(*args, cwd=path)
+            if returncode != 0:
+                break
+    if returncode != 0:
+        verb_msg("{}:\n{}".format(git_url, stderr))
+        return None
+
+    _, new_head, _ = await run_git("rev-parse", "HEAD", cwd=path)
+    if verbose:
+        print("Fetched {}".format(git_url))
+    return "unchanged" if new_head == old_head else "updated"
+
+
+async def git_update(git_url, path, verbose=False, reclone=False):
+    """Bring the repository at $path up to date with $git_url: fetch into an
+    existing clone or clone it if there is none (or $reclone is set). Return
+    "cloned", "updated" or "unchanged" if successful and None otherwise."""
+    if os.path.exists(os.path.join(path, ".git")):
+        if not reclone:
+            return await git_fetch(git_url, path, verbose)
+        # get rid of local repo if it already exists
+        shutil.rmtree(path)
+    return "cloned" if await git_clone(git_url, path, verbose) else None
+
+
+def get_mirror_path(mirror_dir, git_url):
+    """Return the path of the bare mirror of $git_url in $mirror_dir."""
+    name = os.path.basename(git_url.rstrip("/"))
+    if name.endswith(".git"):
+        name = name[:-4]
+    digest = hashlib.sha1(git_url.encode("utf-8")).hexdigest()[:12]
+    return os.path.join(mirror_dir, "{}-{}.git".format(name, digest))
+
+
+class MirrorLock(object):
+    """Asynchronous context manager holding an exclusive lock on the mirror
+    at $mirror_path, so that updates running in different working
+    directories at the same time don't interfere. Without fcntl (i.e. on
+    Windows) no lock is taken."""
+
+    def __init__(self, mirror_path):
+        self.path = "{}.lock".format(mirror_path)
+
+    async def __aenter__(self):
+        self.file_ = open(self.path, "a")
+        while fcntl is not None:
+            try:
+                fcntl.flock(self.file_, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                await asyncio.sleep(0.1)
+        return self
+
+    async def __aexit__(self, *args):
+        # closing the file releases the lock
+        self.file_.close()
+
+
+async def git_mirror(git_url, mirror_path, verbose=False):
+    """Create the bare mirror of $git_url at $mirror_path or fetch into it if
+    it already exists. Return True if succesful, otherwise False."""
+    with profiling.phase("mirror", repo=git_url):
+        async with MirrorLock(mirror_path):
+            return await _git_mirror(git_url, mirror_path, verbose)
+
+
+async def _git_mirror(git_url, mirror_path, verbose=False):
+    if os.path.isdir(mirror_path):
+        if verbose:
+            print("Fetching {} into mirror...".format(git_url))
+        returncode, _, stderr = await run_git(
+            "--git-dir", mirror_path, "fetch", "--prune", "origin"
+        )
+    else:
+        if verbose:
+            print("Mirroring {}...".format(git_url))
+        # clone next to the final path first, so that an interrupted clone
+        # never leaves a broken mirror behind
+        tmp_path = "{}.{}.tmp".format(mirror_path, os.getpid())
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        try:
+            returncode, _, stderr = await run_git("clone", "--mirror", git_url, tmp_path)
+            if returncode == 0:
+                os.rename(tmp_path, mirror_path)
+        finally:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    if returncode != 0:
+        verb_msg("{}:\n{}".format(git_url, stderr))
+        return False
+    return True
+
+
+async def sync_repo(git_url, path, job_options):
+    """Update the repository at $path from $git_url with git_update. If
+    $job_options.mirror_dir is set, the mirror of $git_url in it is updated
+    first and the repository at $path is cloned from and updated with the
+    mirror instead, so only the mirror ever contacts $git_url."""
+    if job_options.mirror_dir is None:
+        return await git_update(git_url, path, job_options.verbose, job_options.reclone)
+
+    mirror_path = get_mirror_path(job_options.mirror_dir, git_url)
+    if not await git_mirror(git_url, mirror_path, job_options.verbose):
+        return None
+    return await git_update(mirror_path, path, job_options.verbose, job_options.reclone)
+
+
+async def update_repo(git_url, path, job_options):
+    """Update the repository at $path from $git_url with sync_repo. Give up
+    on an attempt after $job_options.timeout seconds and retry failed
+    attempts up to $job_options.retries times, waiting longer before each
+    retry. Print and return the outcome."""
+    start = time.perf_counter()
+    for attempt in range(job_options.retries + 1):
+        if attempt:
+            await asyncio.sleep(RETRY_DELAY * 2 ** (attempt - 1))
+            if job_options.verbose:
+                print("Retrying {}...".format(git_url))
+
+        async with job_options.semaphore:
+            try:
+                result = await asyncio.wait_for(
+                    sync_repo(git_url, path, job_options), job_options.timeout
+                )
+            except asyncio.TimeoutError:
+                verb_msg(
+                    "{}:\nTimed out after {} seconds.".format(
+                        git_url, job_options.timeout
+                    )
+                )
+                result = None
+        if result is not None:
+            break
+
+    elapsed = time.perf_counter() - start
+    name = os.path.relpath(path, rel_to_cwd())
+    job_options.results.append((name, result, elapsed))
+    print(
+        "[{}/{}] {}: {} ({:.1f}s)".format(
+            len(job_options.results),
+            job_options.total,
+            name,
+            result or "failed",
+            elapsed,
+        )
+    )
+    return result
+
+
+async def update_source(name, git_url, job_options):
+    """Update source repository $name from $git_url, then all repositories
+    listed in its list.yaml, which are placed in a directory called $name.
+    The listed repositories are updated concurrently with those of other
+    sources."""
+    await update_repo(git_url, rel_to_cwd("sources", name), job_options)
+    # a list.yaml left from a previous update is still used if this one
+    # failed
+    list_file = rel_to_cwd("sources", name, "list.yaml")
+    jobs = list(generate_jobs_from_yaml(list_file, name))
+    job_options.total += len(jobs)
+    await asyncio.gather(*[update_repo(url, path, job_options) for url, path in jobs])
+
+
+async def update_scheduler(sources_file, job_options):
+    """Update all sources in $sources_file along with the repositories they
+    list, running at most $job_options.max_jobs git processes at once."""
+    job_options.semaphore = asyncio.Semaphore(job_options.max_jobs)
+    sources = get_yaml_dict(sources_file)
+    job_options.total = len(sources)
+    await asyncio.gather(
+        *[update_source(name, url, job_options) for name, url in sources.items()]
+    )
 
 
 def generate_jobs_from_yaml(yaml_file, base_dir):
@@ -63,43 +300,75 @@ def generate_jobs_from_yaml(yaml_file, base_dir):
         yield (value, rel_to_cwd(base_dir, key))
 
 
-def update(custom_sources=False, verbose=False):
-    """Update function to be called from cli.py"""
+def update(
+    custom_sources=False,
+    verbose=False,
+    reclone=False,
+    max_jobs=MAX_GIT_JOBS,
+    timeout=GIT_TIMEOUT,
+    retries=GIT_RETRIES,
+    mirror_dir=None,
+):
+    """Update function to be called from cli.py. Existing repositories are
+    updated in place unless $reclone is set. Scheme and template
+    repositories are updated as soon as their source repository is, with at
+    most $max_jobs git processes running at once. Each attempt is given
+    $timeout seconds and failed ones are retried up to $retries times.
+    If $mirror_dir (or the environment variable PYBASE16_MIRROR_DIR) is set,
+    all repositories are mirrored there and cloned from the mirrors, which
+    can be shared by any number of working directories. Return True if all
+    repositories were updated successfully. Raise a ValueError if any of the
+    limits is out of range."""
+    if max_jobs < 1:
+        raise ValueError("The number of git processes must be at least 1.")
+    if timeout is not None and not timeout > 0:
+        raise ValueError("The timeout must be positive.")
+    if retries < 0:
+        raise ValueError("The number of retries can't be negative.")
     if not shutil.which("git"):
         print("Git executable not found in $PATH.")
         sys.exit(1)
 
-    results = []
+    if not custom_sources:
+        print("Creating sources.yaml…")
+        write_sources_file()
+    sources_file = rel_to_cwd("sources.yaml")
+    if not os.path.isfile(sources_file):
+        raise FileNotFoundError(None, None, sources_file)
+
+    mirror_dir = mirror_dir or os.environ.get(MIRROR_DIR_ENV) or None
+    if mirror_dir is not None:
+        mirror_dir = os.path.abspath(mirror_dir)
+        os.makedirs(mirror_dir, exist_ok=True)
+
+    job_options = JobOptions(
+        mirror_dir=mirror_dir,
+        verbose=verbose,
+        reclone=reclone,
+        max_jobs=max_jobs,
+        timeout=timeout,
+        retries=retries,
+        results=[],
+        total=0,
+    )
+    start = time.perf_counter()
     with compat_event_loop() as event_loop:
-        if not custom_sources:
-            print("Creating sources.yaml…")
-            write_sources_file()
-
-        print("Cloning sources…")
-        sources_file = rel_to_cwd("sources.yaml")
-        r = event_loop.run_until_complete(
-            git_clone_scheduler(sources_file, rel_to_cwd("sources"), verbose=verbose)
-        )
-        results.append(r)
-
-        print("Cloning templates…")
-        r = event_loop.run_until_complete(
-            git_clone_scheduler(
-                rel_to_cwd("sources", "templates", "list.yaml"),
-                rel_to_cwd("templates"),
-                verbose=verbose,
-            )
-        )
-        results.append(r)
-
-        print("Cloning schemes…")
-        r = event_loop.run_until_complete(
-            git_clone_scheduler(
-                rel_to_cwd("sources", "schemes", "list.yaml"),
-                rel_to_cwd("schemes"),
-                verbose=verbose,
-            )
-        )
-        results.append(r)
+        event_loop.run_until_complete(update_scheduler(sources_file, job_options))
 
+    results = [result for _, result, _ in job_options.results]
+    print(
+        "Finished updating in {:.1f}s ({} cloned, {} updated, {} unchanged, "
+        "{} failed).".format(
+            time.perf_counter() - start,
+            results.count("cloned"),
+            results.count("updated"),
+            results.count("unchanged"),
+            results.count(None),
+        )
+    )
+    slowest = sorted(job_options.results, key=lambda r: r[2], reverse=True)[:5]
+    if slowest:
+        print("Slowest repositories:")
+        for name, _, elapsed in slowest:
+            print("  {:>6.1f}s {}".format(elapsed, name))
     return all(results)
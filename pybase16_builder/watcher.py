@@ -0,0 +1,300 @@
+import os
+import time
+import errno
+import select
+import struct
+import fnmatch
+import ctypes
+import ctypes.util
+from . import builder
+from .shared import rel_to_cwd, verb_msg
+
+# inotify constants from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+WATCH_MASK = (
+    IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_ONLYDIR
+)
+EVENT_HEADER = struct.Struct("iIII")
+
+# time to wait for further events after the first one, so that e.g. an
+# editor's save sequence results in a single rebuild
+SETTLE_TIME = 0.1
+
+
+class InotifyWatcher(object):
+    """Reports changes to files in a set of directories using inotify. Raise
+    an OSError if inotify isn't available."""
+
+    def __init__(self, dirs):
+        libc_name = ctypes.util.find_library("c")
+        if libc_name is None:
+            raise OSError(errno.ENOSYS, "libc not found")
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        try:
+            init = self.libc.inotify_init1
+        except AttributeError:
+            raise OSError(errno.ENOSYS, "inotify not supported")
+
+        self.fd = init(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}
+        self.set_dirs(dirs)
+
+    def set_dirs(self, dirs):
+        """Watch $dirs in addition to the directories already watched."""
+        watched = set(self.watches.values())
+        for dir_ in dirs:
+            if dir_ in watched:
+                continue
+            wd = self.libc.inotify_add_watch(
+                self.fd, os.fsencode(dir_), ctypes.c_uint32(WATCH_MASK)
+            )
+            if wd >= 0:
+                self.watches[wd] = dir_
+
+    def _read_events(self):
+        """Return the paths affected by all pending events."""
+        paths = set()
+        try:
+            buffer_ = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return paths
+
+        offset = 0
+        while offset < len(buffer_):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(buffer_, offset)
+            offset += EVENT_HEADER.size
+            name = buffer_[offset : offset + length].rstrip(b"\0")
+            offset += length
+
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            dir_ = self.watches.get(wd)
+            if dir_ is None:
+                continue
+            paths.add(os.path.join(dir_, os.fsdecode(name)) if name else dir_)
+        return paths
+
+    def wait(self, timeout=None):
+        """Block until files change or $timeout seconds pass. Return a set of
+        the paths of changed files and directories."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set()
+
+        paths = self._read_events()
+        while select.select([self.fd], [], [], SETTLE_TIME)[0]:
+            paths |= self._read_events()
+        return paths
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher(object):
+    """Reports changes to files in a set of directories by comparing their
+    modification times and sizes every $interval seconds."""
+
+    def __init__(self, dirs, interval=1.0):
+        self.interval = interval
+        self.dirs = set()
+        self.set_dirs(dirs)
+        self.snapshot = self._get_snapshot()
+
+    def set_dirs(self, dirs):
+        """Watch $dirs in addition to the directories already watched."""
+        self.dirs.update(dirs)
+
+    def _get_snapshot(self):
+        """Return a dictionary mapping the paths of all entries in the
+        watched directories to their modification time and size."""
+        snapshot = {}
+        for dir_ in self.dirs:
+            try:
+                entries = list(os.scandir(dir_))
+            except OSError:
+                continue
+            for entry in entries:
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                snapshot[entry.path] = (stat.st_mtime_ns, stat.st_size)
+        return snapshot
+
+    def wait(self, timeout=None):
+        """Block until files change or $timeout seconds pass. Return a set of
+        the paths of changed files and directories."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            time.sleep(self.interval)
+            snapshot = self._get_snapshot()
+            paths = {
+                path
+                for path in set(snapshot) | set(self.snapshot)
+                if snapshot.get(path) != self.snapshot.get(path)
+            }
+            self.snapshot = snapshot
+            if paths or (deadline is not None and time.monotonic() >= deadline):
+                return paths
+
+    def close(self):
+        pass
+
+
+def get_watcher(dirs, interval=1.0):
+    """Return an InotifyWatcher for $dirs if possible and a PollingWatcher
+    checking every $interval seconds otherwise."""
+    try:
+        return InotifyWatcher(dirs)
+    except OSError:
+        return PollingWatcher(dirs, interval)
+
+
+class WatchSession(object):
+    """Keeps template groups loaded in memory and rebuilds only the outputs
+    affected by changed files. $template_dirs and $schemes restrict the
+    session like the arguments of builder.build; $build_options are passed
+    on to builder.build_templates."""
+
+    def __init__(self, template_dirs=None, schemes=None, **build_options):
+        self.requested_templates = template_dirs
+        self.scheme_patterns = schemes
+        self.build_options = build_options
+        self.base_output_dir = build_options.pop("base_output_dir", None) or (
+            rel_to_cwd("output")
+        )
+        os.makedirs(self.base_output_dir, exist_ok=True)
+        if not os.access(self.base_output_dir, os.W_OK | os.X_OK):
+            raise PermissionError
+        self.template_cache = builder.get_template_cache()
+        self.templates = {}
+        self.scheme_files = []
+
+    def _scan(self):
+        """Return the template selection (see builder.get_template_selection)
+        and scheme files that are currently part of the session."""
+        index = builder.ResourceIndex()
+        selection = builder.get_template_selection(
+            self.requested_templates or index.template_dirs
+        )
+        return selection, index.get_scheme_files(self.scheme_patterns)
+
+    def _load_templates(self, selection):
+        """(Re)load the template groups in $selection. Return those that
+        could be loaded."""
+        loaded = []
+        for path, subs in selection.items():
+            try:
+                self.templates[path] = builder.TemplateGroup(
+                    path, self.template_cache, subs
+                )
+            except Exception as e:
+                self.templates.pop(path, None)
+                verb_msg("{}: {!s}".format(path, e), lvl=2)
+                continue
+            loaded.append(self.templates[path])
+        return loaded
+
+    def _build(self, templates, scheme_files):
+        if not templates or not scheme_files:
+            return True
+        result = builder.build_templates(
+            templates, scheme_files, self.base_output_dir, **self.build_options
+        )
+        self.template_cache.save()
+        return result
+
+    def build_all(self):
+        """Load all templates and build all schemes."""
+        selection, self.scheme_files = self._scan()
+        if not selection or not self.scheme_files:
+            raise LookupError
+        templates = self._load_templates(selection)
+        if not templates:
+            raise LookupError
+        return self._build(templates, self.scheme_files)
+
+    def get_watch_dirs(self):
+        """Return a list of all directories that need to be watched."""
+        dirs = [rel_to_cwd("schemes"), rel_to_cwd("templates")]
+        dirs.extend(entry.path for entry in builder.scan_dirs(rel_to_cwd("schemes")))
+        for entry in builder.scan_dirs(rel_to_cwd("templates")):
+            dirs.extend([entry.path, os.path.join(entry.path, "templates")])
+        return dirs
+
+    def handle_changes(self, paths):
+        """Rebuild the outputs affected by changes to $paths. A changed scheme
+        is rebuilt with all template groups; a changed template group is
+        rebuilt for all schemes. Return True if completed without
+        warnings."""
+        selection, scheme_files = self._scan()
+        changed_groups = set(selection) - set(self.templates)
+        changed_schemes = set(scheme_files) - set(self.scheme_files)
+        for path in set(self.templates) - set(selection):
+            del self.templates[path]
+        self.scheme_files = scheme_files
+
+        templates_dir = rel_to_cwd("templates")
+        for path in paths:
+            if path in scheme_files:
+                changed_schemes.add(path)
+                continue
+            rel_path = os.path.relpath(path, templates_dir)
+            parts = rel_path.split(os.sep)
+            if rel_path.startswith(os.pardir) or len(parts) < 3:
+                continue
+            group_dir = os.path.join(templates_dir, parts[0])
+            if group_dir in selection and (
+                parts[-1] == "config.yaml" or fnmatch.fnmatch(parts[-1], "*.mustache")
+            ):
+                changed_groups.add(group_dir)
+
+        results = []
+        reloaded = self._load_templates(
+            {path: selection[path] for path in sorted(changed_groups)}
+        )
+        results.append(self._build(reloaded, self.scheme_files))
+
+        unchanged = [
+            temp_group
+            for path, temp_group in sorted(self.templates.items())
+            if path not in changed_groups
+        ]
+        changed_schemes = [path for path in scheme_files if path in changed_schemes]
+        results.append(self._build(unchanged, changed_schemes))
+        return all(results)
+
+
+def watch(interval=1.0, **session_options):
+    """Build everything once, then watch schemes and templates and rebuild
+    affected outputs whenever they change. Use inotify if available and poll
+    every $interval seconds otherwise. Runs until interrupted."""
+    session = WatchSession(**session_options)
+    session.build_all()
+    watcher = get_watcher(session.get_watch_dirs(), interval)
+    print("Watching for changes...")
+    try:
+        while True:
+            paths = watcher.wait()
+            if not paths:
+                continue
+            watcher.set_dirs(session.get_watch_dirs())
+            session.handle_changes(paths)
+    finally:
+        watcher.close()
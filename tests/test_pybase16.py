@@ -1,8 +1,14 @@
 import os
+import json
+import asyncio
 import shutil
+import subprocess
+import tarfile
 import tempfile
+import zipfile
 import pytest
-from pybase16_builder import shared, updater, builder, injector
+from pybase16_builder import (shared, updater, builder, injector, renderer, cache,
+                              profiling, watcher, store, cli)
 
 
 @pytest.fixture(scope='module')
@@ -101,6 +107,21 @@ def test_custom_build(clean_dir):
         assert len(os.listdir(out_path)) == 1
 
 
+def test_compiled_renderer(clean_dir):
+    """Test that compiled templates render exactly like pystache across the
+    full template corpus."""
+    templates = [builder.TemplateGroup(path)
+                 for path in builder.get_template_dirs()]
+    contexts = {}
+    for scheme_file in builder.get_scheme_files():
+        scheme = shared.get_yaml_dict(scheme_file)
+        slug = builder.slugify(scheme_file)
+        builder.format_scheme(scheme, slug)
+        contexts[slug] = scheme
+    assert templates and contexts
+    assert renderer.compare_renderers(templates, contexts) == []
+
+
 def test_inject(clean_config):
     """Test injection mode."""
     test_injection = 'TEST\nINJECT\nSTRING'
@@ -119,3 +140,999 @@ def test_inject(clean_config):
         content = file_.read()
         matches = content.find(test_injection)
         assert matches > 0
+
+
+@pytest.fixture(scope='function')
+def workspace(tmp_path, monkeypatch):
+    """Create a minimal working directory with local schemes and templates
+    that doesn't require network access."""
+    scheme_dir = tmp_path / 'schemes' / 'test'
+    scheme_dir.mkdir(parents=True)
+    test_scheme = shared.rel_to_cwd('tests', 'test_scheme.yaml')
+    shutil.copy(test_scheme, str(scheme_dir / 'cupertino.yaml'))
+    with open(test_scheme, 'r') as file_:
+        content = file_.read().replace('Cupertino', 'Other & Co')
+    (scheme_dir / 'other.yaml').write_text(content.replace('ffffff', '101010'))
+
+    temp_dir = tmp_path / 'templates' / 'i3' / 'templates'
+    temp_dir.mkdir(parents=True)
+    (temp_dir / 'config.yaml').write_text(
+        'default:\n  extension: .config\n  output: themes\n'
+        'colors:\n  extension: .config\n  output: colors\n')
+    (temp_dir / 'default.mustache').write_text(
+        '# {{scheme-name}} by {{scheme-author}}\n'
+        'set $base00 #{{base00-hex}}\n'
+        'set $base0D {{base0D-rgb-r}} {{base0D-dec-g}} {{base0F-hex-bgr}}\n')
+    (temp_dir / 'colors.mustache').write_text(
+        'client.focused #{{base0D-hex}} {{{scheme-name}}}\n')
+
+    monkeypatch.setattr(shared, 'CWD', str(tmp_path))
+    return tmp_path
+
+
+def test_incremental_build(workspace, capsys):
+    """Test that unchanged outputs are skipped on subsequent builds."""
+    output_dir = str(workspace / 'output')
+    builder.build(base_output_dir=output_dir)
+    assert '4 rebuilt, 0 skipped' in capsys.readouterr().out
+    manifest = builder.load_manifest(output_dir)
+    assert len(manifest['outputs']) == 4
+
+    builder.build(base_output_dir=output_dir)
+    assert '0 rebuilt, 4 skipped' in capsys.readouterr().out
+
+    mustache = workspace / 'templates' / 'i3' / 'templates' / 'colors.mustache'
+    mustache.write_text('client.focused #{{base0E-hex}}\n')
+    builder.build(base_output_dir=output_dir)
+    assert '2 rebuilt, 2 skipped' in capsys.readouterr().out
+    out_file = os.path.join(output_dir, 'i3', 'colors', 'base16-cupertino.config')
+    with open(out_file) as file_:
+        assert file_.read() == 'client.focused #a90d91\n'
+
+    os.remove(out_file)
+    assert builder.build(base_output_dir=output_dir) is True
+    assert '1 rebuilt, 3 skipped' in capsys.readouterr().out
+
+    builder.build(base_output_dir=output_dir, force=True)
+    assert '4 rebuilt, 0 skipped' in capsys.readouterr().out
+
+
+def test_output_permissions(workspace):
+    """Test that rewritten outputs keep their permissions and that new ones
+    get the default permissions."""
+    output_dir = str(workspace / 'output')
+    builder.build(base_output_dir=output_dir)
+    colors_dir = os.path.join(output_dir, 'i3', 'colors')
+    out_file = os.path.join(colors_dir, 'base16-cupertino.config')
+    assert os.stat(out_file).st_mode & 0o777 == 0o666 & ~builder.UMASK
+
+    os.chmod(out_file, 0o640)
+    mustache = workspace / 'templates' / 'i3' / 'templates' / 'colors.mustache'
+    mustache.write_text('client.focused #{{base0E-hex}}\n')
+    builder.build(base_output_dir=output_dir)
+    with open(out_file) as file_:
+        assert file_.read() == 'client.focused #a90d91\n'
+    assert os.stat(out_file).st_mode & 0o777 == 0o640
+    assert sorted(os.listdir(colors_dir)) == ['base16-cupertino.config',
+                                              'base16-other.config']
+
+
+def test_missing_template(workspace, capsys):
+    """Test that requested templates without a config.yaml are skipped."""
+    output_dir = str(workspace / 'output')
+    i3 = str(workspace / 'templates' / 'i3')
+    missing = str(workspace / 'templates' / 'missing')
+    assert builder.build(templates=[i3, missing],
+                         base_output_dir=output_dir) is False
+    output = capsys.readouterr()
+    assert '4 rebuilt' in output.out
+    assert 'Skipping template "missing"' in output.err
+    with pytest.raises(LookupError):
+        builder.build(templates=[missing], base_output_dir=output_dir)
+    with pytest.raises(LookupError):
+        next(builder.iter_build(templates=[missing]))
+    with pytest.raises(LookupError):
+        watcher.WatchSession(template_dirs=[missing]).build_all()
+
+
+@pytest.mark.parametrize('initializer', [True, False])
+def test_parallel_build(workspace, monkeypatch, initializer):
+    """Test that rendering in a process pool yields the same output, also
+    where worker processes can't be initialized."""
+    monkeypatch.setattr(builder, 'POOL_INITIALIZER', initializer)
+    serial_dir = str(workspace / 'serial')
+    parallel_dir = str(workspace / 'parallel')
+    builder.build(base_output_dir=serial_dir)
+    builder.build(base_output_dir=parallel_dir, jobs=2)
+    for temp in ('themes', 'colors'):
+        for scheme in ('cupertino', 'other'):
+            out_file = os.path.join('i3', temp, 'base16-{}.config'.format(scheme))
+            with open(os.path.join(serial_dir, out_file)) as file_:
+                serial = file_.read()
+            with open(os.path.join(parallel_dir, out_file)) as file_:
+                assert file_.read() == serial
+
+
+def test_compiled_template(workspace):
+    """Test compiled templates against pystache for a range of mustache
+    features."""
+    temp_dir = workspace / 'templates' / 'i3' / 'templates'
+    features = {
+        'comment': '{{! comment }}#{{base00-hex}}',
+        'literal': '{{{scheme-name}}} {{&scheme-name}}',
+        'missing': '[{{no-such-key}}]',
+        'delimiters': '{{=<% %>=}}<%base01-hex%> <%scheme-name%>',
+        'section': '{{#scheme-slug}}{{base02-hex}}{{/scheme-slug}}',
+        'inverted': '{{^no-such-key}}none{{/no-such-key}}',
+        'dotted': '{{scheme-name.upper}}',
+    }
+    config = ''
+    for name, content in features.items():
+        (temp_dir / '{}.mustache'.format(name)).write_text(content)
+        config += '{}:\n  extension: .txt\n  output: {}\n'.format(name, name)
+    (temp_dir / 'config.yaml').write_text(config)
+
+    temp_group = builder.TemplateGroup(str(workspace / 'templates' / 'i3'))
+    temps = temp_group.templates
+    for name in ('comment', 'literal', 'missing', 'delimiters'):
+        assert temps[name]['compiled'].compiled
+    for name in ('section', 'inverted', 'dotted'):
+        assert not temps[name]['compiled'].compiled
+
+    contexts = {}
+    for scheme_file in builder.get_scheme_files():
+        scheme = shared.get_yaml_dict(scheme_file)
+        slug = builder.slugify(scheme_file)
+        builder.format_scheme(scheme, slug)
+        contexts[slug] = scheme
+    assert renderer.compare_renderers([temp_group], contexts) == []
+    assert (temps['literal']['compiled'].render(contexts['other'])
+            == 'Other & Co Other & Co')
+
+    # worker processes only receive the variables a batch refers to
+    template_map = {temp_group.name: temp_group}
+    context = builder.get_batch_context(
+        [('i3', 'comment'), ('i3', 'literal')], contexts['other'], template_map)
+    assert context == {'base00-hex': contexts['other']['base00-hex'],
+                       'scheme-name': 'Other & Co'}
+    for name in ('comment', 'literal', 'missing'):
+        assert (temps[name]['compiled'].render(context)
+                == temps[name]['compiled'].render(contexts['other']))
+    assert builder.get_batch_context(
+        [('i3', 'literal'), ('i3', 'section')], contexts['other'],
+        template_map) is contexts['other']
+
+
+def test_template_cache(workspace, monkeypatch):
+    """Test that parsed templates are reused across runs and that entries for
+    deleted templates are removed."""
+    output_dir = str(workspace / 'output')
+    builder.build(base_output_dir=output_dir)
+    template_cache = builder.get_template_cache()
+    assert len(template_cache.entries) == 2
+
+    def fail_parse(*args, **kwargs):
+        raise AssertionError('template parsed despite cache')
+
+    with monkeypatch.context() as patch:
+        patch.setattr(builder.pystache, 'parse', fail_parse)
+        builder.build(base_output_dir=output_dir, force=True)
+
+    temp_dir = workspace / 'templates' / 'i3' / 'templates'
+    (temp_dir / 'colors.mustache').unlink()
+    (temp_dir / 'config.yaml').write_text(
+        'default:\n  extension: .config\n  output: themes\n')
+    builder.build(base_output_dir=output_dir)
+    template_cache = builder.get_template_cache()
+    assert list(template_cache.entries) == [str(temp_dir / 'default.mustache')]
+
+
+def test_template_cache_version(workspace, monkeypatch):
+    """Test that the template cache only holds data and that entries written
+    by another version of pystache or the renderer are discarded."""
+    output_dir = str(workspace / 'output')
+    builder.build(base_output_dir=output_dir)
+    cache_file = workspace / cache.CACHE_DIR / 'templates.json'
+    assert cache_file.exists()
+    assert not list((workspace / cache.CACHE_DIR).glob('*.pickle'))
+
+    with monkeypatch.context() as patch:
+        patch.setattr(builder, 'RENDERER_VERSION', -1)
+        assert builder.get_template_cache().entries == {}
+
+    cache_file.write_text('{"version": null')
+    assert builder.get_template_cache().entries == {}
+
+
+def test_scheme_cache(workspace, monkeypatch, capsys):
+    """Test that unchanged schemes are not parsed again and that invalid
+    schemes are reported."""
+    output_dir = str(workspace / 'output')
+    builder.build(base_output_dir=output_dir)
+    assert len(store.SchemeStore().list_schemes()) == 2
+
+    def fail_load(*args, **kwargs):
+        raise AssertionError('scheme parsed despite cache')
+
+    with monkeypatch.context() as patch:
+        patch.setattr(builder, 'load_scheme', fail_load)
+        assert builder.build(base_output_dir=output_dir, force=True) is True
+
+    scheme_file = workspace / 'schemes' / 'test' / 'other.yaml'
+    scheme_file.write_text(scheme_file.read_text().replace('007400', '#07400'))
+    assert builder.build(base_output_dir=output_dir) is False
+    assert 'Invalid color for base0B' in capsys.readouterr().err
+
+
+def test_scheme_context():
+    """Test that a SchemeContext provides the same variables as
+    format_scheme while only computing them on demand."""
+    scheme_file = shared.rel_to_cwd('tests', 'test_scheme.yaml')
+    scheme = builder.load_scheme(scheme_file)
+    scheme['base0C'] = '31849A'
+    context = builder.SchemeContext(scheme, 'cupertino')
+    assert 'base0C-hex-bgr' in context
+    assert len(context) == 3
+
+    assert context['base0C-hex-bgr'] == '9A8431'
+    assert context['base0C-rgb-b'] == '154'
+    assert context.get('base0C-dec-r') == str(0x31 / 255)
+    assert context.get('no-such-key') is None
+
+    formatted = dict(scheme)
+    builder.format_scheme(formatted, 'cupertino')
+    assert context.to_dict() == formatted
+    assert len(formatted) == 3 + 16 * 11
+
+
+def test_resource_index(workspace):
+    """Test scheme and template discovery against the resource index."""
+    (workspace / 'schemes' / 'test' / 'notes.txt').write_text('')
+    (workspace / 'schemes' / '.hidden').mkdir()
+    (workspace / 'schemes' / '.hidden' / 'hidden.yaml').write_text('')
+    (workspace / 'templates' / 'no-config' / 'templates').mkdir(parents=True)
+
+    index = builder.ResourceIndex()
+    scheme_dir = str(workspace / 'schemes' / 'test')
+    assert index.get_scheme_dirs() == {scheme_dir}
+    assert index.template_dirs == [str(workspace / 'templates' / 'i3')]
+    assert index.get_scheme_files() == [
+        os.path.join(scheme_dir, 'cupertino.yaml'),
+        os.path.join(scheme_dir, 'other.yaml')]
+    assert index.get_scheme_files(['oth*', 'other', 'missing']) == [
+        os.path.join(scheme_dir, 'other.yaml')]
+    assert builder.get_scheme_files(['[co]*']) == index.get_scheme_files()
+
+
+def test_bounded_scheduler(workspace, monkeypatch):
+    """Test that no more than max_renders schemes are loaded and batches
+    built at once."""
+    scheme_dir = workspace / 'schemes' / 'test'
+    content = (scheme_dir / 'cupertino.yaml').read_text()
+    for num in range(10):
+        (scheme_dir / 'copy-{}.yaml'.format(num)).write_text(content)
+
+    build_batch = builder.build_batch
+    in_flight = []
+    peak = []
+    loaded = []
+
+    async def tracked_build_batch(batch, job_options):
+        in_flight.append(batch)
+        peak.append(len(in_flight))
+        loaded.append(len(job_options.contexts))
+        await asyncio.sleep(0)
+        try:
+            return await build_batch(batch, job_options)
+        finally:
+            in_flight.remove(batch)
+
+    monkeypatch.setattr(builder, 'build_batch', tracked_build_batch)
+    output_dir = str(workspace / 'output')
+    assert builder.build(base_output_dir=output_dir, max_renders=3,
+                         max_open_files=1)
+    assert max(peak) == 3
+    assert max(loaded) == 3
+    assert len(peak) == 12
+    assert len(os.listdir(os.path.join(output_dir, 'i3', 'themes'))) == 12
+
+
+def test_invalid_limits(workspace):
+    """Test that concurrency limits below 1 are rejected."""
+    with pytest.raises(ValueError):
+        builder.build(max_open_files=0)
+    with pytest.raises(ValueError):
+        builder.build(max_renders=-1)
+    for option in ('--max-renders', '--max-open-files'):
+        for value in ('0', '-1', 'x'):
+            with pytest.raises(SystemExit):
+                cli.argparser.parse_args(['build', option, value])
+    args = cli.argparser.parse_args(['build', '--max-renders', '2'])
+    assert args.max_renders == 2
+
+    with pytest.raises(ValueError):
+        builder.build(jobs=-4)
+    with pytest.raises(ValueError):
+        injector.inject_into_files(['other'], [], jobs=0)
+    for args in (['build', '-j', '-4'], ['inject', '-s', 'x', '-f', 'y', '-j', '0']):
+        with pytest.raises(SystemExit):
+            cli.argparser.parse_args(args)
+    assert cli.argparser.parse_args(['build', '-j', '0']).jobs == 0
+
+    for options in ({'max_jobs': 0}, {'timeout': 0}, {'retries': -1}):
+        with pytest.raises(ValueError):
+            updater.update(**options)
+    for args in (['-j', '0'], ['--timeout', '0'], ['--timeout', 'nan'],
+                 ['--retries', '-1']):
+        with pytest.raises(SystemExit):
+            cli.argparser.parse_args(['update'] + args)
+    args = cli.argparser.parse_args(['update', '--timeout', '1.5', '--retries', '0'])
+    assert (args.timeout, args.retries) == (1.5, 0)
+
+
+def test_unit_order(workspace, monkeypatch):
+    """Test that units are batched per scheme unless they are known to be
+    expensive, that batches are built most expensive first and that render
+    times are recorded for later builds."""
+    build_batch = builder.build_batch
+    order = []
+
+    async def tracked_build_batch(batch, job_options):
+        order.append([(unit.temp, unit.scheme_slug) for unit in batch])
+        return await build_batch(batch, job_options)
+
+    monkeypatch.setattr(builder, 'build_batch', tracked_build_batch)
+    output_dir = str(workspace / 'output')
+    profiler = profiling.start()
+    try:
+        assert builder.build(base_output_dir=output_dir, max_renders=1)
+    finally:
+        profiling.stop()
+    assert order == [[('default', 'cupertino'), ('colors', 'cupertino')],
+                     [('default', 'other'), ('colors', 'other')]]
+    report = profiler.get_report()
+    assert report['phases']['build_unit']['calls'] == 4
+    assert {unit for unit, _ in report['slowest']['unit']} == {
+        'i3##default:cupertino', 'i3##default:other',
+        'i3##colors:cupertino', 'i3##colors:other'}
+
+    manifest = builder.load_manifest(output_dir)
+    assert set(manifest['timings']) == {'i3##default', 'i3##colors'}
+    manifest['timings'] = {'i3##default': 0.001, 'i3##colors': 0.02}
+    builder.write_manifest(output_dir, manifest)
+    del order[:]
+    assert builder.build(base_output_dir=output_dir, max_renders=1,
+                         force=True)
+    # only one scheme is loaded at a time with max_renders=1
+    assert order == [[('colors', 'cupertino')], [('default', 'cupertino')],
+                     [('colors', 'other')], [('default', 'other')]]
+
+    # sub-templates with unknown cost come first
+    manifest = builder.load_manifest(output_dir)
+    manifest['timings'] = {'i3##default': 0.02}
+    builder.write_manifest(output_dir, manifest)
+    del order[:]
+    monkeypatch.setattr(builder, 'SPLIT_TIME', 0.05)
+    assert builder.build(base_output_dir=output_dir, max_renders=1,
+                         force=True)
+    assert order[0] == [('default', 'cupertino'), ('colors', 'cupertino')]
+    manifest['timings'] = {'i3##default': 0.02}
+    builder.write_manifest(output_dir, manifest)
+    del order[:]
+    monkeypatch.setattr(builder, 'SPLIT_TIME', 0.01)
+    assert builder.build(base_output_dir=output_dir, max_renders=1,
+                         force=True)
+    assert order[:2] == [[('colors', 'cupertino')], [('default', 'cupertino')]]
+
+
+def test_archive_build(workspace):
+    """Test building straight into tar and zip archives."""
+    tar_path = str(workspace / 'themes.tar.gz')
+    zip_path = str(workspace / 'themes.zip')
+    assert builder.build(archive=tar_path)
+    assert builder.build(archive=zip_path)
+    assert not os.path.exists(str(workspace / 'output'))
+
+    expected = {'i3/themes/base16-cupertino.config',
+                'i3/themes/base16-other.config',
+                'i3/colors/base16-cupertino.config',
+                'i3/colors/base16-other.config'}
+    with tarfile.open(tar_path) as tar:
+        assert set(tar.getnames()) == expected
+        content = tar.extractfile('i3/colors/base16-other.config').read()
+    with zipfile.ZipFile(zip_path) as zip_:
+        assert set(zip_.namelist()) == expected
+        assert zip_.read('i3/colors/base16-other.config') == content
+    assert content == b'client.focused #0000ff Other & Co\n'
+
+    with pytest.raises(ValueError):
+        builder.build(archive=str(workspace / 'themes.rar'))
+    with pytest.raises(ValueError, match="Can't write archive"):
+        builder.build(archive=str(workspace / 'missing' / 'themes.tar'))
+
+
+def test_sharded_build(workspace):
+    """Test that sharded builds cover every output exactly once and merge
+    into the same result as a full build."""
+    full_dir = str(workspace / 'full')
+    assert builder.build(base_output_dir=full_dir)
+    full = builder.load_manifest(full_dir)
+
+    shard_dirs = []
+    for index in (1, 2, 3):
+        shard_dir = str(workspace / 'shard{}'.format(index))
+        assert builder.build(base_output_dir=shard_dir, shard=(index, 3))
+        manifest = builder.load_manifest(shard_dir)
+        assert (manifest['shard']['index'], manifest['shard']['count']) == (
+            index, 3)
+        assert all(builder.get_shard(out, 3) == index
+                   for out in manifest['outputs'])
+        shard_dirs.append(shard_dir)
+
+    merged_dir = str(workspace / 'merged')
+    assert builder.merge_shards(shard_dirs, merged_dir) == 4
+    merged = builder.load_manifest(merged_dir)
+    assert merged['outputs'] == full['outputs']
+    assert 'shard' not in merged
+    for out in full['outputs']:
+        with open(os.path.join(full_dir, out)) as file_:
+            expected = file_.read()
+        with open(os.path.join(merged_dir, out)) as file_:
+            assert file_.read() == expected
+
+    with pytest.raises(ValueError):
+        builder.merge_shards(shard_dirs[:2], merged_dir)
+    with pytest.raises(ValueError):
+        builder.merge_shards(shard_dirs + shard_dirs[:1], merged_dir)
+    with pytest.raises(ValueError):
+        builder.merge_shards([full_dir], merged_dir)
+
+    # outputs claimed by several shards are detected before anything is
+    # merged
+    dup_dir = str(workspace / 'dup')
+    shutil.copytree(shard_dirs[2], dup_dir)
+    dup = builder.load_manifest(dup_dir)
+    dup['outputs'].update(builder.load_manifest(shard_dirs[0])['outputs'])
+    with open(os.path.join(dup_dir, builder.MANIFEST_NAME), 'w') as file_:
+        json.dump(dup, file_)
+    with pytest.raises(ValueError, match='more than one shard'):
+        builder.merge_shards(shard_dirs[:2] + [dup_dir],
+                             str(workspace / 'dup-merged'))
+    assert not os.path.exists(str(workspace / 'dup-merged'))
+
+    # shards of different selections or inputs don't make up a full build
+    other_dir = str(workspace / 'other')
+    assert builder.build(base_output_dir=other_dir, shard=(3, 3),
+                         schemes=['cupertino'])
+    with pytest.raises(ValueError):
+        builder.merge_shards(shard_dirs[:2] + [other_dir], merged_dir)
+    scheme_file = workspace / 'schemes' / 'test' / 'other.yaml'
+    scheme_file.write_text(scheme_file.read_text().replace('101010', '202020'))
+    assert builder.build(base_output_dir=other_dir, shard=(3, 3))
+    with pytest.raises(ValueError):
+        builder.merge_shards(shard_dirs[:2] + [other_dir], merged_dir)
+    with pytest.raises(ValueError):
+        builder.build(archive=str(workspace / 'shard.tar'), shard=(1, 2))
+    for shard in ('0/2', '3/2', 'x', '1/2/3'):
+        with pytest.raises(ValueError):
+            builder.parse_shard(shard)
+    assert builder.parse_shard('2/5') == (2, 5)
+
+
+def test_skip_identical_writes(workspace, capsys):
+    """Test that outputs with unchanged content are not rewritten."""
+    output_dir = str(workspace / 'output')
+    builder.build(base_output_dir=output_dir)
+    assert '4 new, 0 updated, 0 unchanged' in capsys.readouterr().out
+
+    out_file = os.path.join(output_dir, 'i3', 'colors', 'base16-cupertino.config')
+    os.utime(out_file, (0, 0))
+    scheme_file = workspace / 'schemes' / 'test' / 'cupertino.yaml'
+    scheme_file.write_text(scheme_file.read_text().replace(
+        'base00: "ffffff"', 'base00: "eeeeee"'))
+    assert builder.build(base_output_dir=output_dir) is False
+    output = capsys.readouterr()
+    assert '0 new, 1 updated, 1 unchanged' in output.out
+    assert 'base16-cupertino.config exists' in output.err
+    assert os.stat(out_file).st_mtime == 0
+    assert not [name for name in os.listdir(os.path.dirname(out_file))
+                if name.endswith('.tmp')]
+
+
+def test_profiling(workspace):
+    """Test recording per-phase timings through the hook surface."""
+    recorded = []
+    profiler = profiling.start()
+    profiler.add_hook(lambda name, elapsed, labels: recorded.append(name))
+    try:
+        builder.build(base_output_dir=str(workspace / 'output'))
+    finally:
+        assert profiling.stop() is profiler
+    assert not profiling.is_active()
+
+    report = profiler.get_report()
+    assert report['phases']['render']['calls'] == 4
+    assert report['phases']['write']['calls'] == 4
+    assert report['phases']['load_scheme']['calls'] == 2
+    assert recorded.count('render') == 4
+    assert {item for item, _ in report['slowest']['scheme']} == {
+        'cupertino', 'other'}
+    assert len(report['slowest']['template']) == 2
+    assert 'Phases:' in profiling.format_summary(report)
+
+
+def test_watch_session(workspace, capsys):
+    """Test that watch mode only rebuilds outputs affected by changes."""
+    output_dir = str(workspace / 'output')
+    session = watcher.WatchSession(base_output_dir=output_dir)
+    assert session.build_all() is True
+    assert '4 rebuilt' in capsys.readouterr().out
+
+    scheme_file = str(workspace / 'schemes' / 'test' / 'other.yaml')
+    with open(scheme_file) as file_:
+        content = file_.read()
+    with open(scheme_file, 'w') as file_:
+        file_.write(content.replace('Other & Co', 'Changed'))
+    session.handle_changes({scheme_file})
+    assert '2 rebuilt, 0 skipped' in capsys.readouterr().out
+
+    temp_dir = workspace / 'templates' / 'i3' / 'templates'
+    (temp_dir / 'colors.mustache').write_text('#{{base0E-hex}}\n')
+    session.handle_changes({str(temp_dir / 'colors.mustache')})
+    assert '2 rebuilt, 2 skipped' in capsys.readouterr().out
+    out_file = os.path.join(output_dir, 'i3', 'colors', 'base16-other.config')
+    with open(out_file) as file_:
+        assert file_.read() == '#a90d91\n'
+
+    new_dir = workspace / 'templates' / 'vim' / 'templates'
+    new_dir.mkdir(parents=True)
+    (new_dir / 'config.yaml').write_text(
+        'default:\n  extension: .vim\n  output: colors\n')
+    (new_dir / 'default.mustache').write_text('{{scheme-slug}}\n')
+    session.handle_changes({str(new_dir)})
+    assert '2 rebuilt, 0 skipped' in capsys.readouterr().out
+    assert os.path.isfile(
+        os.path.join(output_dir, 'vim', 'colors', 'base16-other.vim'))
+
+    session.handle_changes({str(workspace / 'unrelated.txt')})
+    assert capsys.readouterr().out == ''
+
+
+def test_polling_watcher(tmp_path):
+    """Test that the polling watcher reports new, changed and removed
+    files."""
+    path = tmp_path / 'scheme.yaml'
+    path.write_text('a')
+    poller = watcher.PollingWatcher([str(tmp_path)], interval=0.01)
+    assert poller.wait(timeout=0.05) == set()
+    path.write_text('ab')
+    assert poller.wait(timeout=1) == {str(path)}
+    path.unlink()
+    assert poller.wait(timeout=1) == {str(path)}
+
+
+def test_iter_build(workspace):
+    """Test streaming rendered outputs without writing files."""
+    results = list(builder.iter_build())
+    assert not os.path.exists(str(workspace / 'output'))
+    assert [result[:3] for result in results] == [
+        ('i3', 'default', 'cupertino'),
+        ('i3', 'colors', 'cupertino'),
+        ('i3', 'default', 'other'),
+        ('i3', 'colors', 'other'),
+    ]
+    assert results[3][3] == 'client.focused #0000ff Other & Co\n'
+
+    output_dir = str(workspace / 'output')
+    builder.build(base_output_dir=output_dir)
+    for group, temp, slug, rendered in results:
+        out_file = os.path.join(output_dir, group, 'themes' if temp == 'default'
+                                else temp, 'base16-{}.config'.format(slug))
+        with open(out_file) as file_:
+            assert file_.read() == rendered
+
+    filtered = builder.iter_build(schemes=['oth*'])
+    assert {result[2] for result in filtered} == {'other'}
+    with pytest.raises(LookupError):
+        next(builder.iter_build(schemes=['missing']))
+
+
+def test_batch_inject(workspace, monkeypatch):
+    """Test that injecting into several files loads the scheme once and
+    renders each sub-template at most once."""
+    files = []
+    for num, temp in enumerate(['i3##colors', 'i3##colors', 'i3##']):
+        path = workspace / 'config{}'.format(num)
+        path.write_text('before\n# %%base16_template: {} %%\nold\n'
+                        '# %%base16_template_end%%\nafter\n'.format(temp))
+        files.append(str(path))
+
+    loaded_schemes = []
+    load_scheme = builder.load_scheme
+    monkeypatch.setattr(builder, 'load_scheme',
+                        lambda path: loaded_schemes.append(path) or
+                        load_scheme(path))
+    loaded_templates = []
+    get_compiled = builder.get_compiled_template
+    monkeypatch.setattr(builder, 'get_compiled_template',
+                        lambda path, cache=None: loaded_templates.append(
+                            os.path.basename(path)) or get_compiled(path, cache))
+
+    injector.inject_into_files(['other'], files)
+    assert len(loaded_schemes) == 1
+    assert sorted(loaded_templates) == ['colors.mustache', 'default.mustache']
+    with open(files[1]) as file_:
+        assert file_.read() == (
+            'before\n# %%base16_template: i3##colors %%\n'
+            'client.focused #0000ff Other & Co\n\n'
+            '# %%base16_template_end%%\nafter\n')
+    with open(files[2]) as file_:
+        assert '# Other &amp; Co by' in file_.read()
+
+    with pytest.raises(ValueError):
+        injector.inject_into_files(['*'], files)
+
+
+def test_multi_block_inject(workspace, monkeypatch):
+    """Test injecting into several marker blocks of one file, including
+    memory-mapped large files."""
+    path = workspace / 'config'
+    filler = '# filler\n' * 1000
+    path.write_bytes(
+        ('# %%base16_template: i3##colors %%\nold\n# %%base16_template_end%%\n'
+         + filler +
+         '# %%base16_template: i3##default %%\r\n'
+         '# %%base16_template: i3##colors %%\r\nold\r\n'
+         '# %%base16_template_end%%\r\n'
+         '# %%base16_template_end%%\nend').encode('utf-8'))
+    os.chmod(str(path), 0o600)
+
+    rec = injector.Recipient(str(path))
+    assert [block.temp for block in rec.blocks] == ['i3##colors', 'i3##default']
+    rec.close()
+
+    monkeypatch.setattr(injector, 'MMAP_THRESHOLD', 1)
+    injector.inject_into_files(['other'], [str(path)])
+    content = path.read_bytes().decode('utf-8')
+    assert content.startswith(
+        '# %%base16_template: i3##colors %%\n'
+        'client.focused #0000ff Other & Co\n\n# %%base16_template_end%%\n'
+        + filler + '# %%base16_template: i3##default %%\r\n# Other &amp; Co')
+    assert content.endswith(
+        'set $base00 #101010\n'
+        'set $base0D 0 0.0 286b82\n\n'
+        '# %%base16_template_end%%\r\n# %%base16_template_end%%\nend')
+    assert os.stat(str(path)).st_mode & 0o777 == 0o600
+    assert os.listdir(str(workspace)).count('.config.tmp') == 0
+
+
+def test_inject_symlink(workspace, monkeypatch, capsys):
+    """Test that injecting into a symlink writes the file it points to and
+    keeps its owner, rewriting it in place if necessary."""
+    real = workspace / 'dotfiles' / 'config'
+    real.parent.mkdir()
+    real.write_text('# %%base16_template: i3##colors %%\n'
+                    '# %%base16_template_end%%\n')
+    link = workspace / 'config'
+    link.symlink_to(real)
+    expected = ('# %%base16_template: i3##colors %%\n'
+                'client.focused #0000ff Other & Co\n\n'
+                '# %%base16_template_end%%\n')
+
+    assert injector.inject_into_files(['other'], [str(link)])
+    assert link.is_symlink()
+    assert real.read_text() == expected
+    assert os.listdir(str(real.parent)) == ['config']
+
+    # the same file given several times is only written once
+    real.write_text(expected.replace('Other', 'Old'))
+    assert injector.inject_into_files(
+        ['other'], [str(link), str(real), str(link)])
+    assert '(1 updated, 0 unchanged, 0 failed)' in capsys.readouterr().out
+    assert real.read_text() == expected
+
+    if os.geteuid() != 0:
+        return
+    # a file owned by someone else can't be replaced if chown fails
+    real.write_text(expected.replace('Other', 'Old'))
+    os.chown(str(real), 1234, 1234)
+    inode = os.stat(str(real)).st_ino
+
+    def chown(*args):
+        raise PermissionError
+
+    real_chown = os.chown
+    monkeypatch.setattr(injector.os, 'chown', chown)
+    assert injector.inject_into_files(['other'], [str(link)])
+    stat = os.stat(str(real))
+    assert (stat.st_uid, stat.st_gid, stat.st_ino) == (1234, 1234, inode)
+    assert real.read_text() == expected
+    assert os.listdir(str(real.parent)) == ['config']
+
+    monkeypatch.setattr(injector.os, 'chown', real_chown)
+    real.write_text(expected.replace('Other', 'Old'))
+    assert injector.inject_into_files(['other'], [str(link)])
+    stat = os.stat(str(real))
+    assert (stat.st_uid, stat.st_gid) == (1234, 1234)
+    assert real.read_text() == expected
+
+
+def test_inject_outcomes(workspace, capsys):
+    """Test that injection skips unchanged files and reports failures per
+    file without aborting."""
+    paths = [str(workspace / 'config{}'.format(num)) for num in range(4)]
+    for path in paths[:2]:
+        with open(path, 'w') as file_:
+            file_.write('# %%base16_template: i3##colors %%\n'
+                        '# %%base16_template_end%%\n')
+    with open(paths[2], 'w') as file_:
+        file_.write('no markers\n')
+
+    assert injector.inject_into_files(['other'], paths[:2], jobs=2) is True
+    assert '(2 updated, 0 unchanged, 0 failed)' in capsys.readouterr().out
+    os.utime(paths[0], (0, 0))
+
+    assert injector.inject_into_files(['other'], paths, jobs=2) is False
+    output = capsys.readouterr()
+    assert '{}: unchanged'.format(paths[0]) in output.out
+    assert '(0 updated, 2 unchanged, 2 failed)' in output.out
+    assert '"{}" has no valid injection marker lines.'.format(
+        paths[2]) in output.err
+    assert 'Lacking resource "{}"'.format(paths[3]) in output.err
+    assert os.stat(paths[0]).st_mtime == 0
+
+
+def test_template_selection(workspace, monkeypatch, capsys):
+    """Test that templates are parsed on first use and that single
+    sub-templates can be selected for building."""
+    parsed = []
+    get_compiled = builder.get_compiled_template
+    monkeypatch.setattr(builder, 'get_compiled_template',
+                        lambda path, cache=None: parsed.append(
+                            os.path.basename(path)) or get_compiled(path, cache))
+
+    temp_path = shared.rel_to_cwd('templates', 'i3')
+    temp_group = builder.TemplateGroup(temp_path)
+    assert parsed == []
+    assert temp_group.templates['colors']['output'] == 'colors'
+    assert temp_group.templates['colors']['compiled'].render(
+        {'base0D-hex': 'abcdef'}) == 'client.focused #abcdef \n'
+    assert parsed == ['colors.mustache']
+
+    assert builder.get_template_selection(
+        [temp_path + '##colors', temp_path + '##', 'other']) == {
+            temp_path: ['colors', 'default'], 'other': None}
+
+    output_dir = str(workspace / 'output')
+    del parsed[:]
+    builder.build(templates=[temp_path + '##colors'], base_output_dir=output_dir)
+    assert '2 rebuilt' in capsys.readouterr().out
+    assert parsed == ['colors.mustache']
+    assert os.listdir(os.path.join(output_dir, 'i3')) == ['colors']
+
+    with pytest.raises(ValueError):
+        builder.build(templates=[temp_path + '##missing'],
+                      base_output_dir=output_dir)
+
+
+def git(*args, cwd=None):
+    """Run git with a fixed identity and return its stripped output."""
+    return subprocess.run(
+        ['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com',
+         '-c', 'init.defaultBranch=main'] + list(args),
+        cwd=cwd, check=True, stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE).stdout.decode().strip()
+
+
+def make_repo(path, files):
+    """Create a git repository at $path containing $files, a dictionary
+    mapping relative paths to contents, and return $path."""
+    for name, content in files.items():
+        os.makedirs(os.path.join(path, os.path.dirname(name)), exist_ok=True)
+        with open(os.path.join(path, name), 'w') as file_:
+            file_.write(content)
+    if not os.path.isdir(os.path.join(path, '.git')):
+        git('init', '-q', path)
+    git('add', '-A', cwd=path)
+    git('commit', '-q', '-m', 'update', cwd=path)
+    return path
+
+
+@pytest.fixture(scope='function')
+def remote_sources(tmp_path, monkeypatch):
+    """Create local scheme and template repositories (one of them bare) and
+    a working directory whose sources.yaml points to them."""
+    remote = str(tmp_path / 'remote')
+    with open(shared.rel_to_cwd('tests', 'test_scheme.yaml')) as file_:
+        scheme = file_.read()
+    scheme_repo = make_repo(os.path.join(remote, 'scheme'), {'test.yaml': scheme})
+    template_repo = make_repo(os.path.join(remote, 'template'), {
+        'templates/config.yaml': 'default:\n  extension: .conf\n  output: out\n',
+        'templates/default.mustache': '{{base00-hex}}\n'})
+    bare_repo = os.path.join(remote, 'template.git')
+    git('clone', '-q', '--bare', template_repo, bare_repo)
+
+    schemes_source = make_repo(os.path.join(remote, 'schemes-source'), {
+        'list.yaml': 'test: file://{}\n'.format(scheme_repo)})
+    templates_source = make_repo(os.path.join(remote, 'templates-source'), {
+        'list.yaml': 'i3: {}\n'.format(bare_repo)})
+
+    workspace = tmp_path / 'workspace'
+    workspace.mkdir()
+    (workspace / 'sources.yaml').write_text(
+        'schemes: file://{}\ntemplates: file://{}\n'.format(
+            schemes_source, templates_source))
+    monkeypatch.setattr(shared, 'CWD', str(workspace))
+    return {'workspace': workspace, 'scheme': scheme_repo,
+            'schemes-source': schemes_source}
+
+
+def test_incremental_repo_sync(remote_sources, monkeypatch, capsys):
+    """Test that existing clones are fetched into instead of recloned."""
+    monkeypatch.setattr(updater, 'RETRY_DELAY', 0)
+    workspace = remote_sources['workspace']
+    assert updater.update(custom_sources=True) is True
+    assert '(4 cloned, 0 updated, 0 unchanged, 0 failed)' in \
+        capsys.readouterr().out
+    scheme_clone = str(workspace / 'schemes' / 'test')
+    assert git('rev-parse', '--is-shallow-repository',
+               cwd=scheme_clone) == 'true'
+    assert os.path.isfile(str(workspace / 'templates' / 'i3' / 'templates' /
+                              'default.mustache'))
+
+    assert updater.update(custom_sources=True) is True
+    assert '(0 cloned, 0 updated, 4 unchanged, 0 failed)' in \
+        capsys.readouterr().out
+
+    make_repo(remote_sources['scheme'], {'test.yaml': 'scheme: "New"\n'})
+    with open(os.path.join(scheme_clone, 'test.yaml'), 'a') as file_:
+        file_.write('local change\n')
+    assert updater.update(custom_sources=True) is True
+    output = capsys.readouterr().out
+    assert os.path.join('schemes', 'test') + ': updated' in output
+    assert '(0 cloned, 1 updated, 3 unchanged, 0 failed)' in output
+    with open(os.path.join(scheme_clone, 'test.yaml')) as file_:
+        assert file_.read() == 'scheme: "New"\n'
+
+    assert updater.update(custom_sources=True, reclone=True) is True
+    assert '(4 cloned, 0 updated, 0 unchanged, 0 failed)' in \
+        capsys.readouterr().out
+
+    make_repo(remote_sources['schemes-source'], {
+        'list.yaml': 'broken: file:///nonexistent/repo\n'})
+    assert updater.update(custom_sources=True) is False
+    assert os.path.join('schemes', 'broken') + ': failed' in \
+        capsys.readouterr().out
+
+
+def test_update_pipeline(tmp_path, monkeypatch, capsys):
+    """Test that listed repositories are updated as soon as their source is,
+    with bounded concurrency, timeouts and retries."""
+    (tmp_path / 'sources.yaml').write_text('schemes: s\ntemplates: t\n')
+    monkeypatch.setattr(shared, 'CWD', str(tmp_path))
+    monkeypatch.setattr(updater, 'RETRY_DELAY', 0)
+    events = []
+    running = []
+    attempts = {}
+
+    async def git_update(git_url, path, verbose=False, reclone=False):
+        running.append(git_url)
+        events.append(('start', git_url, len(running)))
+        attempts[git_url] = attempts.get(git_url, 0) + 1
+        try:
+            if git_url == 's':
+                os.makedirs(path)
+                with open(os.path.join(path, 'list.yaml'), 'w') as file_:
+                    file_.write('a: s-a\nb: s-b\nc: s-c\n')
+            elif git_url == 't':
+                # the templates source is slow; scheme repos shouldn't wait
+                await asyncio.sleep(0.05)
+            elif git_url == 's-b' and attempts[git_url] < 3:
+                return None
+            elif git_url == 's-c':
+                await asyncio.sleep(1)
+            return 'cloned'
+        finally:
+            running.remove(git_url)
+            events.append(('end', git_url))
+
+    monkeypatch.setattr(updater, 'git_update', git_update)
+    assert updater.update(custom_sources=True, max_jobs=2, timeout=0.1,
+                          retries=2) is False
+    output = capsys.readouterr()
+
+    assert max(event[2] for event in events if event[0] == 'start') == 2
+    assert events.index(('start', 's-a', 2)) < events.index(('end', 't'))
+    assert attempts == {'s': 1, 't': 1, 's-a': 1, 's-b': 3, 's-c': 3}
+    assert 'Timed out after 0.1 seconds.' in output.err
+    assert '[5/5]' in output.out
+    assert os.path.join('schemes', 'c') + ': failed' in output.out
+    assert '(4 cloned, 0 updated, 0 unchanged, 1 failed)' in output.out
+    assert 'Slowest repositories:' in output.out
+
+
+def test_update_mirror(remote_sources, tmp_path, monkeypatch, capsys):
+    """Test that working directories are updated through shared bare
+    mirrors."""
+    mirror_dir = str(tmp_path / 'mirrors')
+    monkeypatch.setenv(updater.MIRROR_DIR_ENV, mirror_dir)
+    assert updater.update(custom_sources=True) is True
+    assert '(4 cloned' in capsys.readouterr().out
+
+    mirrors = sorted(name for name in os.listdir(mirror_dir)
+                     if name.endswith('.git'))
+    assert len(mirrors) == 4
+    scheme_mirror = updater.get_mirror_path(
+        mirror_dir, 'file://' + remote_sources['scheme'])
+    assert os.path.basename(scheme_mirror) in mirrors
+    assert git('rev-parse', '--is-bare-repository',
+               cwd=scheme_mirror) == 'true'
+    scheme_clone = str(remote_sources['workspace'] / 'schemes' / 'test')
+    assert git('remote', 'get-url', 'origin', cwd=scheme_clone) == \
+        scheme_mirror
+
+    # a second working directory only needs the mirrors
+    other = tmp_path / 'other'
+    other.mkdir()
+    shutil.copy(str(remote_sources['workspace'] / 'sources.yaml'), str(other))
+    monkeypatch.setattr(shared, 'CWD', str(other))
+    make_repo(remote_sources['scheme'], {'test.yaml': 'scheme: "New"\n'})
+    assert updater.update(custom_sources=True) is True
+    assert '(4 cloned' in capsys.readouterr().out
+    with open(str(other / 'schemes' / 'test' / 'test.yaml')) as file_:
+        assert file_.read() == 'scheme: "New"\n'
+
+    monkeypatch.setattr(shared, 'CWD', str(remote_sources['workspace']))
+    assert updater.update(custom_sources=True) is True
+    assert '(0 cloned, 1 updated, 3 unchanged, 0 failed)' in \
+        capsys.readouterr().out
+
+
+def test_scheme_store(workspace, monkeypatch, capsys):
+    """Test that formatted scheme contexts are stored by builds and used by
+    injections and the schemes command."""
+    builder.build(base_output_dir=str(workspace / 'output'))
+    scheme_store = store.SchemeStore()
+    contexts = scheme_store.load_all()
+    other_file = str(workspace / 'schemes' / 'test' / 'other.yaml')
+    assert sorted(contexts) == [
+        str(workspace / 'schemes' / 'test' / 'cupertino.yaml'), other_file]
+    assert contexts[other_file]['base00-hex'] == '101010'
+    assert contexts[other_file]['base0D-rgb-b'] == '255'
+    assert scheme_store.find('other') == [(other_file, contexts[other_file])]
+    scheme_store.close()
+
+    def fail_load(*args, **kwargs):
+        raise AssertionError('scheme parsed despite store')
+
+    path = workspace / 'config'
+    path.write_text('# %%base16_template: i3##colors %%\n'
+                    '# %%base16_template_end%%\n')
+    with monkeypatch.context() as patch:
+        patch.setattr(builder, 'load_scheme', fail_load)
+        assert injector.inject_into_files(['other'], [str(path)]) is True
+    capsys.readouterr()
+
+    def run_cli(*args):
+        monkeypatch.setattr('sys.argv', ['pybase16', 'schemes'] + list(args))
+        with pytest.raises(SystemExit) as exit_info:
+            cli.run()
+        return exit_info.value.code, capsys.readouterr()
+
+    monkeypatch.setattr(builder, 'ResourceIndex', fail_load)
+    code, output = run_cli('list')
+    assert code == 0
+    assert output.out.splitlines()[1].split() == [
+        'other', 'Other', '&', 'Co', 'by', 'Defman21']
+    code, output = run_cli('show', 'other')
+    assert code == 0
+    assert 'base0D-hex: 0000ff' in output.out.splitlines()
+    assert run_cli('show', 'missing')[0] == 1
+
+    os.remove(other_file)
+    monkeypatch.undo()
+    monkeypatch.setattr(shared, 'CWD', str(workspace))
+    monkeypatch.setattr('sys.argv', ['pybase16', 'schemes', 'list', '-r'])
+    with pytest.raises(SystemExit):
+        cli.run()
+    assert 'other' not in capsys.readouterr().out